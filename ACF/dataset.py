@@ -8,31 +8,37 @@ from torch.utils.data import Dataset
 from PIL import Image
 import torchvision.transforms as transforms
 import torch
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import CSR, ChunkedCSR, ComplementPool, LazyImages, has_csr, has_image_cache, has_image_store, load_csr, \
+    load_ftr, load_id_map, load_image_cache, load_image_store, train_excluded
 
 def load_data(data_path, feature_type):
 	
     start = time.time()
     feature_dir = os.path.join(data_path,'../')
-    train_df = pd.read_feather(os.path.join(data_path, 'train_positive.ftr'))
-    test_df = pd.read_feather(os.path.join(data_path, 'test_positive.ftr'))
-    train_ng_pool = pd.read_feather(os.path.join(data_path, 'train_negative.ftr'))
-    test_negative = pd.read_feather(os.path.join(data_path, 'test_negative.ftr'))
-    
-    
-    train_df = train_df.astype('int64')
-    test_df = test_df.astype('int64')
-    train_df.rename(columns={"userid":"userID","train_pos":"itemID"}, inplace=True)
-    test_df.rename(columns={"userid":"userID","test_pos":"itemID"}, inplace=True)
-    train_ng_pool = train_ng_pool["train_negative"].tolist()
-    test_negative = test_negative["test_negative"].tolist()
-    
-    index_info = pd.read_csv(os.path.join(data_path,'../index-info/item_index.csv'))
+    item_map = load_id_map(os.path.join(data_path,'../index-info'), 'item')
+    if has_csr(data_path):
+        # positives-only split. train negatives are derived at sampling time
+        train_pos = load_csr(data_path, 'train_positive')
+        test_pos = load_csr(data_path, 'test_positive')
+        test_negative = load_csr(data_path, 'test_negative')
+        val_pos = load_csr(data_path, 'val_positive') if has_csr(data_path, 'val_positive') else None
+        train_ng_pool = ComplementPool(len(item_map), train_excluded(data_path, train_pos, test_pos, test_negative, val_pos))
+    else:
+        # feather split. lists are views of the memory-mapped files
+        test_negative = load_ftr(data_path, 'test_negative')
+        train_pos = load_ftr(data_path, 'train_positive', len(test_negative))
+        test_pos = load_ftr(data_path, 'test_positive', len(test_negative))
+        train_ng_pool = load_ftr(data_path, 'train_negative')
+    train_df = pd.DataFrame({"userID":train_pos.rows(),"itemID":train_pos.indices.astype('int64')})
+    test_df = pd.DataFrame({"userID":test_pos.rows(),"itemID":test_pos.indices.astype('int64')})
     
     num_user = max(train_df["userID"])+1
     num_item = max(train_df["itemID"])+1
 
-    index_list = index_info["itemidx"].tolist()
-    id_list = index_info["itemid"].tolist()
+    index_list = list(range(len(item_map)))
+    id_list = item_map.keys.tolist()
 
     with open(os.path.join(feature_dir,"item_meta.json"), "rb") as f:
         meta_data = json.load(f)
@@ -49,20 +55,22 @@ def load_data(data_path, feature_type):
     images = []
 
     
-    if feature_type == "all" or feature_type == "img":
+    if (feature_type == "all" or feature_type == "img") and has_image_cache(feature_dir):
+        # uint8 cache built by image_cache.py, normalized when gathered
+        images = load_image_cache(feature_dir, (0.5,), (0.5,))
+    elif feature_type == "all" or feature_type == "img":
         transform = transforms.Compose([transforms.Resize((224,224)),
                                             transforms.ToTensor(),
                                             transforms.Normalize((0.5,),(0.5,))])
-        
-        for i in range(len(image_path_list)):
-            img = Image.open(image_path_list[i]).convert("RGB")
-            img = transform(img)
-            images.append(img)
-            
+        # decoded on first access, from the packed image store if there is one
+        images = LazyImages(load_image_store(feature_dir) if has_image_store(feature_dir) else image_path_list, transform)
+
     end = time.time()
     print(f"Data Loaded {end-start}. num user : {num_user} num item : {num_item}")
     
-    return train_df, test_df, train_ng_pool, test_negative, num_user, num_item, torch.stack(images)
+    if isinstance(images, list):
+        images = torch.stack(images)
+    return train_df, test_df, train_ng_pool, test_negative, num_user, num_item, images
 
 
 class CustomDataset(Dataset):
@@ -73,7 +81,7 @@ class CustomDataset(Dataset):
         self.images = images # Tensor
         self.positive_set = train.groupby("userID")["itemID"].apply(np.array)
         #import pdb; pdb.set_trace() # Check min(Positive Item)
-        self.negative = np.array(negative) # list->np
+        self.negative = negative if isinstance(negative, (CSR, ChunkedCSR, ComplementPool)) else np.array(negative) # list->np
         self.feature_type = feature_type
         if not istrain:
             self.test = np.array(test)
@@ -1,66 +1,102 @@
-from PIL import Image
 from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 import torch
-import random
 import time
 import os
 import pandas as pd
 import numpy as np
 import json
-import pickle
-
-def load_data(data_path, feature_type):
-    start = time.time()
-    feature_dir = os.path.join(data_path, '../')
-    train_df = pd.read_feather(os.path.join(data_path, 'train_positive.ftr'))
-    test_df = pd.read_feather(os.path.join(data_path, 'test_positive.ftr'))
-    train_ng_pool = pd.read_feather(os.path.join(data_path, 'train_negative.ftr'))
-    test_negative = pd.read_feather(os.path.join(data_path, 'test_negative.ftr'))
-
-    train_df = train_df.astype('int64')
-    test_df = test_df.astype('int64')
-    train_df.rename(columns={"userid": "userID", "train_pos": "itemID"}, inplace=True)
-    test_df.rename(columns={"userid": "userID", "test_pos": "itemID"}, inplace=True)
-    train_ng_pool = train_ng_pool["train_negative"].tolist()
-    test_negative = test_negative["test_negative"].tolist()
-
-    index_info = pd.read_csv(os.path.join(data_path, '../index-info/item_index.csv'))
-    num_user = max(train_df["userID"]) + 1
-    num_item = index_info.shape[0]
-
-    id_list = index_info["itemid"].tolist()
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import AliasTable, CSR, ChunkedCSR, ComplementPool, LazyImages, has_csr, has_ftr, has_image_cache, \
+    has_image_store, load_csr, fingerprint, load_feature_bank, load_ftr, load_id_map, load_image_cache, \
+    load_image_store, load_snapshot, load_text_feature, sample_negatives, save_snapshot, train_excluded, \
+    candidate_lists, segment_index, Candidates
+
+def make_snapshot(train_pos, test_pos, test_negative, item_map, feature_dir):
+    # load_data arrays derived from the split, item_meta.json and the text features
+    snapshot = {}
+    snapshot['train'] = np.stack([train_pos.rows(), train_pos.indices.astype('int64')], 1)
+    snapshot['test'] = np.stack([test_pos.rows(), test_pos.indices.astype('int64')], 1)
+    # Candidates (positives + negatives) of each test user as a padded matrix.
+    test = Candidates.from_pairs(snapshot['test'][:, 0], snapshot['test'][:, 1], test_negative)
+    snapshot['test_users'], snapshot['test_num_pos'], snapshot['test_lengths'], snapshot['test_items'] = \
+        test.users, test.num_pos, test.lengths, test.items
+    snapshot['num_user'] = np.array([snapshot['train'][:, 0].max() + 1])
+
+    id_list = item_map.keys.tolist()
 
     with open(os.path.join(feature_dir, "item_meta.json"), "rb") as f:
         meta_data = json.load(f)
-    with open(os.path.join(feature_dir, 'text_feature_vec.pickle'), 'rb') as f:
-        text_vec = pickle.load(f)
     image_path_list = []
-    t_features = []
     for item_id in id_list:
-        t_features.append(text_vec[item_id])
         img_path = meta_data[f"{item_id}"]["image_path"]
         image_path_list.append(os.path.abspath(os.path.join(feature_dir, img_path)))
+    snapshot['image_path'] = np.array(image_path_list)
+
+    snapshot['text_feature'] = load_text_feature(feature_dir, id_list)
+    return snapshot
+
 
-    t_features = np.array(t_features)
-    t_features = dict(enumerate(t_features, 0))
-    image_path_list = np.array(image_path_list)
+def load_data(data_path, feature_type, feature_data_type='raw', hier_attention=False, sampling='uniform'):
+    start = time.time()
+    feature_dir = os.path.join(data_path, '../')
+    item_map = load_id_map(os.path.join(data_path, '../index-info'), 'item')
+    num_item = len(item_map)
+    if has_csr(data_path):
+        # positives-only split. train negatives are derived at sampling time
+        train_pos = load_csr(data_path, 'train_positive')
+        test_pos = load_csr(data_path, 'test_positive')
+        test_negative = load_csr(data_path, 'test_negative')
+        val_pos = load_csr(data_path, 'val_positive') if has_csr(data_path, 'val_positive') else None
+        train_ng_pool = ComplementPool(num_item, train_excluded(data_path, train_pos, test_pos, test_negative, val_pos))
+    else:
+        # feather split. lists are views of the memory-mapped files
+        test_negative = load_ftr(data_path, 'test_negative')
+        train_pos = load_ftr(data_path, 'train_positive', len(test_negative))
+        test_pos = load_ftr(data_path, 'test_positive', len(test_negative))
+        val_pos = load_ftr(data_path, 'val_positive', len(test_negative)) if has_ftr(data_path, 'val_positive') else None
+        train_ng_pool = load_ftr(data_path, 'train_negative')
+    if sampling == 'popularity':
+        if not isinstance(train_ng_pool, ComplementPool):
+            # a stored pool has no membership test, popularity draws are rejected against the excluded lists
+            train_ng_pool = ComplementPool(num_item, train_excluded(data_path, train_pos, test_pos, test_negative, val_pos))
+        # negatives in proportion to the train degree of the items
+        train_ng_pool.table = AliasTable(np.bincount(train_pos.items(), minlength=num_item))
+
+    # Derived arrays are restored from the snapshot of a previous run while the input files are unchanged.
+    snapshot_dir = os.path.join(data_path, 'snapshot', fingerprint(
+        [feature_dir], feature_type, contents=[data_path, os.path.join(feature_dir, 'index-info'),
+                                               os.path.join(feature_dir, 'item_meta.json'), __file__]))
+    snapshot = load_snapshot(snapshot_dir)
+    if snapshot is None:
+        snapshot = save_snapshot(snapshot_dir, make_snapshot(train_pos, test_pos, test_negative, item_map, feature_dir))
+    train_df = pd.DataFrame(snapshot['train'], columns=["userID", "itemID"], copy=False)
+    test_df = pd.DataFrame(snapshot['test'], columns=["userID", "itemID"], copy=False)
+    test_candidates = Candidates(snapshot['test_users'], snapshot['test_num_pos'], snapshot['test_lengths'],
+                                 snapshot['test_items'])
+    num_user = int(snapshot['num_user'][0])
+
+    t_features = snapshot['text_feature']
+    image_path_list = snapshot['image_path']
     images = []
 
-    if feature_type == "all" or feature_type == "img":
+    if (feature_type == "all" or feature_type == "img") and feature_data_type == 'pre':
+        # features of the frozen extractor built by feature_bank.py, pooled maps of every level for hierarchical attention
+        images = load_feature_bank(feature_dir, 'feature_bank_levels' if hier_attention else 'feature_bank')
+    elif (feature_type == "all" or feature_type == "img") and has_image_cache(feature_dir):
+        # uint8 cache built by image_cache.py, normalized when gathered
+        images = load_image_cache(feature_dir, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    elif feature_type == "all" or feature_type == "img":
         transform = transforms.Compose([transforms.Resize((224, 224)),
                                         transforms.ToTensor(),
                                         transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                                              std=[0.229, 0.224, 0.225])])
-        for i in range(len(image_path_list)):
-            img = Image.open(image_path_list[i]).convert("RGB")
-            img = transform(img)
-            images.append(img)
-        images = torch.stack(images)
-        # images = dict(enumerate(images,0))
+        # decoded on first access, from the packed image store if there is one
+        images = LazyImages(load_image_store(feature_dir) if has_image_store(feature_dir) else image_path_list, transform)
 
     print(f"Data Loaded. num user : {num_user} num item : {num_item} {time.time() - start:.4f} sec")
-    return train_df, test_df, train_ng_pool, test_negative, num_user, num_item, t_features, images
+    return train_df, test_df, train_ng_pool, test_negative, num_user, num_item, t_features, images, test_candidates
 
 
 class CustomDataset(Dataset):
@@ -84,35 +120,27 @@ class CustomDataset(Dataset):
         self.dataset = dataset  # df
         self.text_feature = text_feature  # dictionary(np)
         self.images = images  # dictionary(tensor)
-        self.negative = np.array(negative)  # list->np
+        self.negative = negative if isinstance(negative, (CSR, ChunkedCSR, ComplementPool)) else np.array(negative)  # list->np
         self.istrain = istrain
         self.num_neg = num_neg
         self.feature_type = feature_type
+        self.rng, self.seed = None, None
 
         if not istrain:
             self.make_testset()
         else:
-            self.dataset = np.array(self.dataset)
+            self.dataset = self.dataset.to_numpy()  # view of the shared DataFrame
 
     def make_testset(self):
         assert not self.istrain
-        users = np.unique(self.dataset["userID"])
-        test_dataset=[]
-        for user in users:
-            if type(self.negative[user]) == list:
-                test_negative = self.negative[user]
-            elif type(self.negative[user]) == np.ndarray:
-                test_negative = self.negative[user].tolist()
-            test_positive = self.dataset[self.dataset["userID"] == user]["itemID"].tolist()
-            item = test_positive + test_negative
-            label = np.zeros(len(item))
-            label[:len(test_positive)] = 1
-            test_user = np.ones(len(item)) * user
-
-            testset=np.vstack((test_user,np.array(item),label)).T
-            test_dataset.append(testset)
-
-        test_dataset=np.concatenate(test_dataset).astype(np.int64)
+        # Positives then negatives of every user, the same order as the Candidates of load_data
+        users, num_pos, lengths, items = candidate_lists(self.dataset["userID"].to_numpy(),
+                                                         self.dataset["itemID"].to_numpy(), self.negative)
+
+        test_dataset = np.zeros((lengths.sum(), 3), dtype=np.int64)
+        test_dataset[:, 0] = np.repeat(users, lengths)
+        test_dataset[:, 1] = items
+        test_dataset[:, 2] = segment_index(np.zeros_like(lengths), lengths) < np.repeat(num_pos, lengths)
 
         self.dataset = test_dataset
 
@@ -121,50 +149,52 @@ class CustomDataset(Dataset):
     def __len__(self):
         return len(self.dataset)
 
-    def __getitem__(self, index):
-        if self.istrain:
-            user, item_p = self.dataset[index]
-            # Negative sampling
-            ng_pool = np.array(self.negative[user])
-            idx = np.random.choice(len(ng_pool), self.num_neg, replace=False)
-            # idx = random.sample(list(range(0,len(ng_pool))), self.num_neg)
-            item_n = ng_pool[idx].tolist()
-
-            ####
-            item_idx = item_n.copy()
-            item_idx.insert(0, item_p)
-
-            t_feature_p, t_feature_n, img_p, img_n = 0.0, [0.0,0.0,0.0,0.0], torch.Tensor([0.0]), torch.zeros(self.num_neg,1)
-
-            if self.feature_type == "txt" or self.feature_type == "all":
-                # t_feature = self.text_feature[item_idx]
-                t_feature = []
-                for i in item_idx:
-                    t_feature.append(self.text_feature[i])
-                t_feature_p = t_feature[0]
-                t_feature_n = np.array(t_feature[1:])
-
-            if self.feature_type == "img" or self.feature_type == "all":
-                # img = self.images[item_idx]
-                img = []
-                for j in item_idx:
-                    img.append(self.images[j])
-                img_p = img[0]
-                img_n = torch.stack(img[1:])
-
-            return user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n
-
-        else:
-            user, item, label = self.dataset[index]
-
-            t_feature, img = [0.0], torch.Tensor([0.0])
+    def generator(self):
+        # np.random.Generator of this DataLoader worker, torch seeds every worker differently in every epoch
+        seed = torch.initial_seed()
+        if self.seed != seed:
+            self.rng, self.seed = np.random.default_rng(seed), seed
+        return self.rng
+
+    def __getitems__(self, indices):
+        # Whole batch as tensors. Negatives are drawn in one call, features gathered in one op per source.
+        if not self.istrain:
+            user, item, label = self.dataset[indices, 0], self.dataset[indices, 1], self.dataset[indices, 2]
+            return [torch.from_numpy(user), torch.from_numpy(item), self.gather_text(item), self.gather_image(item),
+                    torch.from_numpy(label).float()]
+
+        user, item_p = self.dataset[indices, 0], self.dataset[indices, 1]
+        # CSR and feather pools hold int32 items
+        item_n = sample_negatives(self.negative, user, self.num_neg, self.generator()).astype(np.int64, copy=False)
+        item = np.concatenate([item_p[:, None], item_n], 1)
+        t_feature, img = self.gather_text(item), self.gather_image(item)
+        return [torch.from_numpy(user), torch.from_numpy(item_p), torch.from_numpy(item_n), t_feature[:, 0],
+                t_feature[:, 1:], img[:, 0], img[:, 1:]]
+
+    def gather_text(self, item):
+        # text features of an index array, one fancy-index op into a preallocated float32 tensor
+        if self.feature_type != "txt" and self.feature_type != "all":
+            return torch.zeros(item.shape)
+        out = torch.empty(item.shape + self.text_feature.shape[1:])
+        # item indices are valid, 'clip' skips the bounds check that would buffer the output
+        np.take(self.text_feature, item, axis=0, out=out.numpy(), mode='clip')
+        return out
+
+    def gather_image(self, item):
+        # images (or extractor features) of an index array, gathered at once by the image source
+        if self.feature_type != "img" and self.feature_type != "all":
+            return torch.zeros(item.shape + (1,))
+        image = self.images[item.ravel()]
+        return image.view(item.shape + image.shape[1:])
 
-            if self.feature_type == "txt" or self.feature_type == "all":
-                for i in [item]:
-                    t_feature = np.array(self.text_feature[i])
+    def __getitem__(self, index):
+        # batch of one sample
+        return self.__getitems__([index])
 
-            if self.feature_type == "img" or self.feature_type == "all":
-                for j in [item]:
-                    img = self.images[j]
 
-            return user, item, t_feature, img, label
+def collate_batch(batch):
+    # __getitems__ (torch>=2.0) returns whole batches as tensors, nothing is left to collate
+    if isinstance(batch[0], torch.Tensor):
+        return batch
+    # older DataLoaders fetch sample by sample with __getitem__, every sample is a batch of one
+    return [torch.cat(field) for field in zip(*batch)]
@@ -8,10 +8,11 @@ from torch.utils.data import DataLoader
 import numpy as np
 import torch.multiprocessing as mp
 from utils import Logger, AverageMeter, str2bool
-from model_attention import MAML
+from model import MAML
 from loss import Embedding_loss, Feature_loss, Covariance_loss
 import dataset as D
-from metric import get_performance
+from storage import share_memory
+from metric import batch_performance
 import torch.distributed as dist
 
 
@@ -46,6 +47,10 @@ parser.add_argument('--eval_freq', default=50, type=int,
                     help='evaluate performance every n epoch')
 parser.add_argument('--feature_type', default='rating', type=str,
                     help='Type of feature to use. [rating, all, img, txt]')
+parser.add_argument('--feature_data_type', default='raw', type=str,
+                    help='raw(png) or pre(vector, feature_bank.py)')
+parser.add_argument('--sampling', default='uniform', type=str,
+                    help='negative sampling, uniform or popularity(train degree)')
 parser.add_argument('--eval_type', default='leave-one-out', type=str,
                     help='Evaluation protocol. [ratio-split, leave-one-out]')
 parser.add_argument('--cnn_path', default='./pretrained_model/resnet18.pth', type=str,
@@ -58,9 +63,12 @@ parser.add_argument('--ddp_port', default='88888', type=str,
                     help='DDP Port')
 parser.add_argument('--att_wd', default=100, type=float)
 args = parser.parse_args()
+if args.feature_data_type == 'pre' and args.fine_tuning:
+    # the bank was produced by the frozen extractor
+    parser.error('--fine_tuning needs --feature_data_type raw')
 
 
-def main(rank, args):
+def main(rank, args, data):
     # Initialize Each Process
     init_process(rank, args.world_size)
 
@@ -73,11 +81,8 @@ def main(rank, args):
             json.dump(args.__dict__, f, indent=2)
 
 
-    # Load dataset
-    print("Loading Dataset")
-    data_path = os.path.join(args.data_path, args.eval_type)
-    train_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images = D.load_data(
-        data_path, args.feature_type)
+    # Dataset loaded once before the ranks were forked
+    train_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images, test_candidates = data
     train_dataset = D.CustomDataset(train_df, text_feature, images, negative=train_ng_pool, num_neg=args.num_neg,
                                     istrain=True, feature_type=args.feature_type)
     test_dataset = D.CustomDataset(test_df, text_feature, images, negative=test_negative, num_neg=None,
@@ -89,14 +94,14 @@ def main(rank, args):
                                                                     num_replicas=args.world_size,
                                                                     shuffle=True)
     train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4,
-                              collate_fn=my_collate_trn, pin_memory=True, sampler=train_sampler)
+                              collate_fn=D.collate_batch, pin_memory=True, sampler=train_sampler)
     test_loader = DataLoader(test_dataset, batch_size=int(args.batch_size/4), shuffle=False, num_workers=4,
-                             collate_fn=my_collate_tst, pin_memory=True)
+                             collate_fn=D.collate_batch, pin_memory=True)
 
     # Model
     t_feature_dim = text_feature[0].shape[-1]
     model = MAML(num_user, num_item, args.embed_dim, args.dropout_rate, args.feature_type, t_feature_dim,
-                 args.cnn_path,args.fine_tuning,rank).cuda(rank)
+                 args.cnn_path,args.fine_tuning,rank,args.feature_data_type).cuda(rank)
     model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank], find_unused_parameters=True)
 
     if args.load_path is not None:
@@ -137,7 +142,7 @@ def main(rank, args):
         if (epoch + 1) % args.eval_freq == 0:
             if dist.get_rank() == 0:
                 start = time.time()
-                test(model, test_loader, test_logger, epoch, args.hier_attention)
+                test(model, test_loader, test_logger, epoch, args.hier_attention, test_candidates)
                 torch.save(model.state_dict(), f"{save_path}/model_{epoch + 1}.pth")
                 print('test time : ', time.time() - start, 'sec/epoch => ', (time.time() - start) / 60, 'min')
 
@@ -205,7 +210,7 @@ def train(model, embedding_loss, feature_loss, covariance_loss, optimizer, scale
                             feat_loss.avg, cov_loss.avg])
 
 
-def test(model, test_loader, test_logger, epoch, hier_attention):
+def test(model, test_loader, test_logger, epoch, hier_attention, candidates):
     model.eval()
     hr_10 = AverageMeter()
     hr2_10 = AverageMeter()
@@ -219,14 +224,15 @@ def test(model, test_loader, test_logger, epoch, hier_attention):
     hr_1 = AverageMeter()
     hr2_1 = AverageMeter()
     ndcg_1 = AverageMeter()
+    meters = {10: (hr_10, hr2_10, ndcg_10), 5: (hr_5, hr2_5, ndcg_5), 3: (hr_3, hr2_3, ndcg_3), 1: (hr_1, hr2_1, ndcg_1)}
 
 
     data_time = AverageMeter()
     iter_time = AverageMeter()
-    user_cat = torch.tensor([]).cuda(dist.get_rank())
-    score_cat=torch.tensor([]).cuda(dist.get_rank())
-    label_cat=torch.tensor([]).cuda(dist.get_rank())
-    item_cat = torch.tensor([]).cuda(dist.get_rank())
+    # Distances of the padded candidate matrix, the padding is never recommended
+    scores = torch.full(candidates.items.shape, float('inf')).cuda(dist.get_rank())
+    flat_index = torch.from_numpy(candidates.flat_index()).cuda(dist.get_rank())
+    start = 0
     end = time.time()
 
     for i, (user, item, feature, image, label) in enumerate(test_loader):
@@ -239,89 +245,35 @@ def test(model, test_loader, test_logger, epoch, hier_attention):
                 feature.cuda(dist.get_rank(), non_blocking=True), image.cuda(dist.get_rank(), non_blocking=True), \
                 label.cuda(dist.get_rank(), non_blocking=True)
             _, _, _, score = model(user, item, feature, image, hier_attention)
-            user_cat=torch.cat((user_cat,user))
-            score_cat=torch.cat((score_cat, score))
-            label_cat=torch.cat((label_cat, label))
-            item_cat=torch.cat((item_cat, item))
+            scores.view(-1)[flat_index[start:start + len(score)]] = score.float()
+            start += len(score)
 
             if i%10==0 and dist.get_rank()==0:
                 print(f"test iter : {i}/{len(test_loader)}")
-
-    for k in np.unique(user_cat.cpu()):
-        index=np.where(np.array(user_cat.cpu().detach())==k)
-        label=label_cat[index]
-        score=score_cat[index]
-        item=item_cat[index]
-        performance_list=[]
-        for m in [10,5,3,1] :
-            pos_idx = label.nonzero()
-            _, indices = torch.topk(-score, m)
-            recommends = torch.take(item, indices).cpu().detach().numpy()
-            gt_item = item[pos_idx].cpu().detach().numpy()
-            performance = get_performance(gt_item, recommends.tolist())
-            performance = torch.tensor(performance).cuda(dist.get_rank())
-            performance_list.append(performance)
-        hr_10.update(performance_list[0][0].cpu().detach().numpy())
-        hr2_10.update(performance_list[0][1].cpu().detach().numpy())
-        ndcg_10.update(performance_list[0][2].cpu().detach().numpy())
-        hr_5.update(performance_list[1][0].cpu().detach().numpy())
-        hr2_5.update(performance_list[1][1].cpu().detach().numpy())
-        ndcg_5.update(performance_list[1][2].cpu().detach().numpy())
-        hr_3.update(performance_list[2][0].cpu().detach().numpy())
-        hr2_3.update(performance_list[2][1].cpu().detach().numpy())
-        ndcg_3.update(performance_list[2][2].cpu().detach().numpy())
-        hr_1.update(performance_list[3][0].cpu().detach().numpy())
-        hr2_1.update(performance_list[3][1].cpu().detach().numpy())
-        ndcg_1.update(performance_list[3][2].cpu().detach().numpy())
-
         iter_time.update(time.time() - end)
         end = time.time()
 
-        if k % 50 == 0 and dist.get_rank() == 0:
-            print(
-                f"{k + 1} Users tested. Iteration time : {iter_time.avg:.5f}/user Data time : {data_time.avg:.5f}/user")
+    # Top-k and metrics of blocks of users as tensor ops
+    positive = torch.from_numpy(candidates.positive()).cuda(dist.get_rank())
+    num_pos = torch.from_numpy(np.array(candidates.num_pos)).cuda(dist.get_rank())
+    for block in range(0, len(candidates), 1024):
+        rows = slice(block, block + 1024)
+        for m in [10, 5, 3, 1]:
+            performance = batch_performance(scores[rows], positive[rows], num_pos[rows], m, largest=False)
+            for meter, value in zip(meters[m], performance):
+                meter.update(value.mean().item(), len(value))
+
     if dist.get_rank() == 0:
         print(
-            f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr_10.avg:.4f} nDCG : {ndcg_10.avg:.4f} Hit Ratio 2 : {hr2_10.avg:.4f} Test Time : {iter_time.avg:.4f}/user")
+            f"{len(candidates)} Users tested. Iteration time : {iter_time.avg:.5f}/iter Data time : {data_time.avg:.5f}/iter")
+        print(
+            f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr_10.avg:.4f} nDCG : {ndcg_10.avg:.4f} Hit Ratio 2 : {hr2_10.avg:.4f} Test Time : {iter_time.avg:.4f}/iter")
         test_logger.write([epoch, hr_10.avg, hr2_10.avg, ndcg_10.avg,\
                            hr_5.avg, hr2_5.avg, ndcg_5.avg,\
                            hr_3.avg,hr2_3.avg, ndcg_3.avg,\
                            hr_1.avg, hr2_1.avg, ndcg_1.avg])
 
 
-def my_collate_trn(batch):
-    user = [item[0] for item in batch]
-    user = torch.LongTensor(user)
-    item_p = [item[1] for item in batch]
-    item_p = torch.LongTensor(item_p)
-    item_n = [item[2] for item in batch]
-    item_n = torch.LongTensor(item_n)
-    t_feature_p = [item[3] for item in batch]
-    t_feature_p = torch.FloatTensor(t_feature_p)
-    t_feature_n = [item[4] for item in batch]
-    t_feature_n = torch.FloatTensor(t_feature_n)
-    img_p = [item[5] for item in batch]
-    img_p = torch.stack(img_p)
-    img_n = [item[6] for item in batch]
-    img_n = torch.stack(img_n)
-
-    return [user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n]
-
-
-def my_collate_tst(batch):
-    user = [items[0] for items in batch]
-    user = torch.LongTensor(user)
-    item = [items[1] for items in batch]
-    item = torch.LongTensor(item)
-    t_feature = [items[2] for items in batch]
-    t_feature = torch.FloatTensor(t_feature)
-    img = [items[3] for items in batch]
-    img = torch.stack(img)
-    label = [items[4] for items in batch]
-    label = torch.FloatTensor(label)
-    return [user, item, t_feature, img, label]
-
-
 def init_process(rank, world_size, backend='nccl'):
     os.environ['MASTER_ADDR'] = '127.0.0.1'
     os.environ['MASTER_PORT'] = args.ddp_port
@@ -337,5 +289,9 @@ def reduce_tensor(tensor, world_size):
 
 if __name__ == "__main__":
     args.world_size = torch.cuda.device_count()
-    mp.spawn(main, nprocs=args.world_size, args=(args,))
+    # Load dataset once. The ranks are forked and read it from shared memory / memory-mapped files.
+    print("Loading Dataset")
+    data = share_memory(D.load_data(os.path.join(args.data_path, args.eval_type), args.feature_type, args.feature_data_type,
+                                    args.hier_attention, args.sampling))
+    mp.start_processes(main, nprocs=args.world_size, args=(args, data), start_method='fork')
     #main()
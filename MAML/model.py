@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import resnet_tv as resnet
 
+# channels of the resnet18 feature_list levels (conv1, layer1-4), the last one is the penultimate feature dim
+RESNET18_CHANNELS = [64, 64, 128, 256, 512]
+
 
 
 class PrintLayer(nn.Module):
@@ -16,7 +19,7 @@ class PrintLayer(nn.Module):
 
 class MAML(nn.Module):
     def __init__(self, n_users, n_items, embed_dim, dropout_rate, feature_type, t_feature_dim,
-                 v_feature_extractor_path, fine_tuning, rank):
+                 v_feature_extractor_path, fine_tuning, rank, feature_data_type='raw'):
         super(MAML, self).__init__()
         self.embed_dim = embed_dim
         self.n_users = n_users
@@ -25,28 +28,28 @@ class MAML(nn.Module):
         self.feature_type = feature_type
         self.t_feature_dim = t_feature_dim
         self.rank = rank
+        self.feature_data_type = feature_data_type
 
         # Embedding Layers
         self.embedding_user = nn.Embedding(n_users, embed_dim, max_norm=1.0)
         self.embedding_item = nn.Embedding(n_items, embed_dim, max_norm=1.0)
 
-        # Image feature extractor module
-        self.v_feature_extractor = resnet.resnet18()
-        self.v_feature_dim = self.v_feature_extractor.fc.in_features
-        self.v_feature_c1 = self.v_feature_extractor.conv1.out_channels
-        self.v_feature_c2 = self.v_feature_extractor.layer1[1].conv2.out_channels
-        self.v_feature_c3 = self.v_feature_extractor.layer2[1].conv2.out_channels
-        self.v_feature_c4 = self.v_feature_extractor.layer3[1].conv2.out_channels
-        self.v_feature_c5 = self.v_feature_extractor.layer4[1].conv2.out_channels
-
-        if v_feature_extractor_path is not None:
-            self.v_feature_extractor.load_state_dict(
-                torch.load(v_feature_extractor_path, map_location='cuda:%d' % self.rank))
-
-        if fine_tuning is False:
-            self.v_feature_extractor.eval()
-            for param in self.v_feature_extractor.parameters():
-                param.requires_grad = False
+        # Image feature extractor module, not built for pre features of feature_bank.py
+        self.v_feature_c1, self.v_feature_c2, self.v_feature_c3, self.v_feature_c4, self.v_feature_c5 = RESNET18_CHANNELS
+        self.v_feature_dim = self.v_feature_c5
+        self.v_feature_levels = list(RESNET18_CHANNELS)
+        if self.feature_data_type == 'raw':
+            self.v_feature_extractor = resnet.resnet18()
+            if v_feature_extractor_path is not None:
+                self.v_feature_extractor.load_state_dict(
+                    torch.load(v_feature_extractor_path, map_location='cuda:%d' % self.rank))
+
+            if fine_tuning is False:
+                self.v_feature_extractor.eval()
+                for param in self.v_feature_extractor.parameters():
+                    param.requires_grad = False
+        else:
+            self.v_feature_extractor = None
 
         # For attention Layers
         self.conv_key1 = nn.Conv2d(self.v_feature_c1, self.embed_dim*2, 1)
@@ -112,8 +115,12 @@ class MAML(nn.Module):
             item_embedding = item_embedding.reshape(item_embedding.size(0) * item_embedding.size(1),
                                                     item_embedding.size(2))
         user_embedding=torch.cat([user_embedding, item_embedding],1)
-        _, feature_map = v_feature_extractor.feature_list(image)
-        feature_map = feature_map[:-1]
+        if self.feature_data_type == 'pre':
+            # pooled maps of the 5 levels from feature_bank.py --levels, as 1 x 1 maps
+            feature_map = [level[..., None, None] for level in torch.split(image, self.v_feature_levels, dim=-1)]
+        else:
+            _, feature_map = v_feature_extractor.feature_list(image)
+            feature_map = feature_map[:-1]
         score = []
         for i in range(len(feature_map)):
             key = key_modules[i](nn.AvgPool2d(feature_map[i].size(-1))(feature_map[i]))
@@ -148,6 +155,8 @@ class MAML(nn.Module):
             if hier_attention:
                 v_feature = self.hierarchical_attention(self.v_feature_extractor, key_modules, value_modules, image,
                                                         p_u, q_i)
+            elif self.feature_data_type == 'pre':
+                v_feature = image
             else:
                 _, v_feature = self.v_feature_extractor.feature_list(image)
                 v_feature = v_feature[5]
@@ -159,6 +168,8 @@ class MAML(nn.Module):
             if hier_attention:
                 v_feature = self.hierarchical_attention(self.v_feature_extractor, key_modules, value_modules, image,
                                                         p_u, q_i)
+            elif self.feature_data_type == 'pre':
+                v_feature = image
             else:
                 _, v_feature = self.v_feature_extractor.feature_list(image)
                 v_feature = v_feature[5]
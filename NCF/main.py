@@ -13,7 +13,8 @@ from utils import Logger, AverageMeter, str2bool
 from model import MAML, NeuralCF
 from loss import Embedding_loss, Feature_loss, Covariance_loss
 import dataset as D
-from metric import get_performance
+from storage import share_memory
+from metric import batch_performance
 import resnet_tv as resnet
 import torch.distributed as dist
 import torchvision.utils as vutils
@@ -54,7 +55,9 @@ parser.add_argument('--eval_freq', default=50, type=int,
 parser.add_argument('--feature_type', default='img', type=str,
                     help='Type of feature to use. [all, img, txt]')
 parser.add_argument('--feature_data_type', default='raw', type=str,
-                    help='raw(png) or pre(vector)')                    
+                    help='raw(png) or pre(vector, feature_bank.py)')                    
+parser.add_argument('--sampling', default='uniform', type=str,
+                    help='negative sampling, uniform or popularity(train degree)')
 parser.add_argument('--eval_type', default='ratio-split', type=str,
                     help='Evaluation protocol. [ratio-split, leave-one-out]')
 parser.add_argument('--cnn_path', default='./resnet18.pth', type=str,
@@ -66,7 +69,7 @@ parser.add_argument('--ddp_addr', default='127.0.0.1', type=str,
 args = parser.parse_args()
 
 
-def main(rank, args):
+def main(rank, args, data):
     # Initialize Each Process
     init_process(rank, args.world_size)
     
@@ -84,11 +87,8 @@ def main(rank, args):
     else:
         experiment = Experiment(disabled=True)
 
-    # Load dataset
-    print("Loading Dataset")
-    data_path = os.path.join(args.data_path, args.eval_type)
-    train_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images, test_pos_item_num, item_num_dict = D.load_data(
-        data_path, args.feature_type) 
+    # Dataset loaded once before the ranks were forked
+    train_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images, test_candidates = data
     train_dataset = D.CustomDataset(args.model, train_df, text_feature, images, negative=train_ng_pool, num_neg=args.num_neg,
                                     istrain=True, feature_type=args.feature_type)
     test_dataset = D.CustomDataset(args.model, test_df, text_feature, images, negative=test_negative, num_neg=None,
@@ -100,15 +100,15 @@ def main(rank, args):
                                                                     num_replicas=args.world_size,
                                                                     shuffle=True)
     train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4,
-                              collate_fn=my_collate_trn, pin_memory=True, sampler=train_sampler)
+                              collate_fn=D.collate_batch, pin_memory=True, sampler=train_sampler)
     test_loader = DataLoader(test_dataset, batch_size=args.batch_size*2, shuffle=False, num_workers=4,
-                             collate_fn=my_collate_tst, pin_memory=True)
+                             collate_fn=D.collate_batch, pin_memory=True)
 
     # Model
     t_feature_dim = text_feature[0].shape[-1]
     if args.model == 'MAML':
         model = MAML(num_user, num_item, args.embed_dim, args.dropout_rate, args.feature_type, t_feature_dim,
-                    args.cnn_path, rank).cuda(rank)
+                    args.cnn_path, rank, args.feature_data_type).cuda(rank)
     else:
         model = NeuralCF(num_users=num_user, num_items=num_item, 
                         embedding_size=args.embed_dim, dropout=args.dropout_rate,
@@ -166,7 +166,7 @@ def main(rank, args):
         if (epoch + 1) % args.eval_freq == 0 or epoch == 0:
             start = time.time()
             test(model=model, model_type=args.model, test_loader=test_loader, test_logger=test_logger, epoch=epoch, 
-                test_pos_item_num=test_pos_item_num, item_num_dict=item_num_dict, experiment=experiment)
+                candidates=test_candidates, experiment=experiment)
             # if rank == 0:
             #     torch.save(model.state_dict(), f"{save_path}/model_{epoch + 1}.pth")
             print('test time : ', time.time() - start, 'sec/epoch => ', (time.time() - start) / 60, 'min')
@@ -267,7 +267,7 @@ def train(model, model_type, optimizer, scaler, train_loader, train_logger, epoc
     #     else: # NCF
     #         train_logger.write([epoch, total_loss.avg])
 
-def test(model, model_type, test_loader, test_logger, epoch, test_pos_item_num, item_num_dict, experiment):
+def test(model, model_type, test_loader, test_logger, epoch, candidates, experiment):
     model.eval()
     hr = AverageMeter()
     hr2 = AverageMeter()
@@ -275,10 +275,13 @@ def test(model, model_type, test_loader, test_logger, epoch, test_pos_item_num,
     data_time = AverageMeter()
     iter_time = AverageMeter()
     
-    score_cat=torch.tensor([]).cuda(dist.get_rank())
+    # padding된 candidate matrix의 score. padding은 추천되지 않음
+    fill = float('inf') if model_type == "MAML" else -float('inf')
+    scores = torch.full(candidates.items.shape, fill).cuda(dist.get_rank())
+    flat_index = torch.from_numpy(candidates.flat_index()).cuda(dist.get_rank())
+    start = 0
     
     end = time.time()
-    user_count = 0
     for i, (user, item, feature, image) in enumerate(test_loader):
         data_time.update(time.time() - end)
         with torch.no_grad():
@@ -290,88 +293,36 @@ def test(model, model_type, test_loader, test_logger, epoch, test_pos_item_num,
                 _, _, _, score = model(user, item, feature, image)
             else: # NCF
                 score = model(user, item, image=image, text=feature, feature_type=args.feature_type)
-            score_cat=torch.cat((score_cat, score))
+            scores.view(-1)[flat_index[start:start + len(score)]] = score.float()
+            start += len(score)
 
             if i%1000==0 and dist.get_rank()==0:
                 print(f"test iter : {i}/{len(test_loader)}")
-                    
-            while(len(score_cat) >= item_num_dict[user_count]): 
-                score_sub_tensor = score_cat[:item_num_dict[user_count]]
-                score_cat = score_cat[item_num_dict[user_count]:]
-                if model_type == "MAML":
-                    _, indices = torch.topk(-score_sub_tensor, args.top_k)
-                else: # NCF
-                    _, indices = torch.topk(score_sub_tensor, args.top_k)    
-                recommends = indices
-                gt_item = torch.tensor(range(test_pos_item_num[user_count])).cuda(dist.get_rank())
-                performance = get_performance(gt_item, recommends)
-                performance = torch.tensor(performance).cuda(dist.get_rank())
-                hr.update(performance[0])
-                hr2.update(performance[1])
-                ndcg.update(performance[2])
-                user_count += 1
-                if user_count == len(item_num_dict.keys()):
-                    break    
-                    
-    print('남은 스코어', score_cat.shape)
-    iter_time.update(time.time() - end)
-    end = time.time()
+        iter_time.update(time.time() - end)
+        end = time.time()
+
+    # user block 단위로 top-k와 metric 계산
+    positive = torch.from_numpy(candidates.positive()).cuda(dist.get_rank())
+    num_pos = torch.from_numpy(np.array(candidates.num_pos)).cuda(dist.get_rank())
+    for block in range(0, len(candidates), 1024):
+        rows = slice(block, block + 1024)
+        performance = batch_performance(scores[rows], positive[rows], num_pos[rows], args.top_k,
+                                        largest=model_type != "MAML")
+        hr.update(performance[0].mean(), len(performance[0]))
+        hr2.update(performance[1].mean(), len(performance[0]))
+        ndcg.update(performance[2].mean(), len(performance[0]))
 
     experiment.log_metric("hit-ratio", hr.avg, step=epoch)
     experiment.log_metric("hit-ratio2", hr2.avg, step=epoch)
     experiment.log_metric("ndcg", ndcg.avg, step=epoch)
 
     if dist.get_rank() == 0:
-        print(f"{user_count} Users tested. Iteration time : {iter_time.avg:.5f}/user Data time : {data_time.avg:.5f}/user")
+        print(f"{len(candidates)} Users tested. Iteration time : {iter_time.avg:.5f}/iter Data time : {data_time.avg:.5f}/iter")
     if dist.get_rank() == 0:
-        print(f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr.avg:.4f} nDCG : {ndcg.avg:.4f} Hit Ratio 2 : {hr2.avg:.4f} Test Time : {iter_time.avg:.4f}/user")
+        print(f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr.avg:.4f} nDCG : {ndcg.avg:.4f} Hit Ratio 2 : {hr2.avg:.4f} Test Time : {iter_time.avg:.4f}/iter")
         # test_logger.write([epoch, float(hr.avg), float(hr2.avg), float(ndcg.avg)])
 
 
-def my_collate_trn(batch):
-    if len(batch[0]) == 7:
-        user = [item[0] for item in batch]
-        user = torch.LongTensor(user)
-        item_p = [item[1] for item in batch]
-        item_p = torch.LongTensor(item_p)
-        item_n = [item[2] for item in batch]
-        item_n = torch.LongTensor(item_n)
-        t_feature_p = [item[3] for item in batch]
-        t_feature_p = torch.FloatTensor(t_feature_p)
-        t_feature_n = [item[4] for item in batch]
-        t_feature_n = torch.FloatTensor(t_feature_n)
-        img_p = [item[5] for item in batch]
-        img_p = torch.stack(img_p)
-        img_n = [item[6] for item in batch]
-        img_n = torch.stack(img_n)
-
-        return [user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n]
-    else:
-        user = [element for item in batch for element in item[0]]
-        user = torch.LongTensor(user)
-        items = [element for item in batch for element in item[1]]
-        items = torch.LongTensor(items)
-        rating = [element for item in batch for element in item[2]]
-        rating = torch.FloatTensor(rating)
-        t_feature = [element for item in batch for element in item[3]]
-        t_feature = torch.FloatTensor(t_feature)
-        img = [element for item in batch for element in item[4]]
-        img = torch.stack(img)
-    
-        return [user, items, rating, t_feature, img]
-
-def my_collate_tst(batch):
-    user = [items[0] for items in batch]
-    user = torch.LongTensor(user)
-    item = [items[1] for items in batch]
-    item = torch.LongTensor(item)
-    t_feature = [items[2] for items in batch]
-    t_feature = torch.FloatTensor(t_feature)
-    img = [items[3] for items in batch]
-    img = torch.stack(img)
-    return [user, item, t_feature, img]
-
-
 def init_process(rank, world_size, backend='nccl'):
     os.environ['MASTER_ADDR'] = args.ddp_addr
     os.environ['MASTER_PORT'] = args.ddp_port
@@ -389,5 +340,9 @@ def cleanup():
 
 if __name__ == "__main__":
     args.world_size = torch.cuda.device_count()
-    mp.spawn(main, nprocs=args.world_size, args=(args,))
+    # Load dataset once. The ranks are forked and read it from shared memory / memory-mapped files.
+    print("Loading Dataset")
+    data = share_memory(D.load_data(os.path.join(args.data_path, args.eval_type), args.feature_type, args.feature_data_type,
+                                    args.sampling))
+    mp.start_processes(main, nprocs=args.world_size, args=(args, data), start_method='fork')
     #main()
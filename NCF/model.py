@@ -7,6 +7,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import resnet_tv
 
+# penultimate feature dim of resnet18
+RESNET18_FEATURE_DIM = 512
+
 class NeuralCF(nn.Module):
     def __init__(self, num_users, num_items, embedding_size, dropout, num_layers, feature_data_type, **kwargs):
         super(NeuralCF,self).__init__()
@@ -17,14 +20,14 @@ class NeuralCF(nn.Module):
         self.item_embedding_mlp = nn.Embedding(num_items, embedding_size)
         
         if (kwargs['feature_type'] == 'img') | (kwargs['feature_type'] == 'all'):
-            self.feature_extractor = resnet_tv.resnet18()
             print("IMAGE FEATURE")
             if self.feature_data_type == 'raw':
+                self.feature_extractor = resnet_tv.resnet18()
                 # map_location = {'cuda:%d' % 0: 'cuda:%d' % kwargs['rank']}
                 self.feature_extractor.load_state_dict(torch.load(kwargs['extractor_path'], map_location='cuda:%d' % kwargs['rank']))    
-            self.feature_extractor.eval()
-            for param in self.feature_extractor.parameters():
-                param.requires_grad = False
+                self.feature_extractor.eval()
+                for param in self.feature_extractor.parameters():
+                    param.requires_grad = False
             self.image_embedding = nn.Linear(512, embedding_size) 
         if (kwargs['feature_type'] == 'txt') | (kwargs['feature_type'] == 'all'):
             print("TEXT FEATURE")
@@ -102,7 +105,8 @@ class NeuralCF(nn.Module):
         return x.view(-1)
 
 class MAML(nn.Module):
-    def __init__(self, n_users, n_items, embed_dim, dropout_rate, feature_type, t_feature_dim, v_feature_extractor_path, rank):
+    def __init__(self, n_users, n_items, embed_dim, dropout_rate, feature_type, t_feature_dim, v_feature_extractor_path, rank,
+                 feature_data_type='raw'):
         super(MAML, self).__init__()
         self.embed_dim = embed_dim
         self.n_users = n_users
@@ -110,20 +114,23 @@ class MAML(nn.Module):
         self.embed_dim = embed_dim
         self.feature_type = feature_type
         self.t_feature_dim = t_feature_dim
+        self.feature_data_type = feature_data_type
 
         # Embedding Layers
         self.embedding_user = nn.Embedding(n_users, embed_dim, max_norm=1.0)
         self.embedding_item = nn.Embedding(n_items, embed_dim, max_norm=1.0)
 
-        # Image feature extractor module
-        self.v_feature_extractor = resnet.resnet18()
-        self.v_feature_dim = self.v_feature_extractor.fc.in_features
-        
-        if v_feature_extractor_path is not None:
-            self.v_feature_extractor.load_state_dict(torch.load(v_feature_extractor_path, map_location='cuda:%d' % rank))
-        self.v_feature_extractor.eval()
-        for param in self.v_feature_extractor.parameters():
-            param.requires_grad = False
+        # Image feature extractor module, not built for pre features of feature_bank.py
+        self.v_feature_dim = RESNET18_FEATURE_DIM
+        if self.feature_data_type == 'raw':
+            self.v_feature_extractor = resnet.resnet18()
+            if v_feature_extractor_path is not None:
+                self.v_feature_extractor.load_state_dict(torch.load(v_feature_extractor_path, map_location='cuda:%d' % rank))
+            self.v_feature_extractor.eval()
+            for param in self.v_feature_extractor.parameters():
+                param.requires_grad = False
+        else:
+            self.v_feature_extractor = None
 
         # Feature Fusion Layers
         """
@@ -183,14 +190,20 @@ class MAML(nn.Module):
 
         # Extract image feature
         if self.feature_type == "img":
-            _, v_feature = self.v_feature_extractor.feature_list(image)
-            v_feature = v_feature[5]
+            if self.feature_data_type == 'pre':
+                v_feature = image
+            else:
+                _, v_feature = self.v_feature_extractor.feature_list(image)
+                v_feature = v_feature[5]
             if len(item.size())==2:
                 v_feature = v_feature.reshape(q_i.size(0),q_i.size(1),-1)
             item_feature = v_feature
         elif self.feature_type == "all":
-            _, v_feature = self.v_feature_extractor.feature_list(image)
-            v_feature = v_feature[5]
+            if self.feature_data_type == 'pre':
+                v_feature = image
+            else:
+                _, v_feature = self.v_feature_extractor.feature_list(image)
+                v_feature = v_feature[5]
             if len(item.size())==2:
                 v_feature = v_feature.reshape(q_i.size(0),q_i.size(1),-1)
             item_feature = torch.cat((v_feature,t_feature), axis=-1)
@@ -0,0 +1,90 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+import resnet_tv
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import LazyImages, has_image_cache, has_image_store, load_id_map, load_image_cache, load_image_store
+
+parser = argparse.ArgumentParser(description='feature_bank')
+parser.add_argument('--data_path', default='/daintlab/data/recommend/Amazon-office-raw', type=str,
+                    help='datapath with item_meta.json and index-info')
+parser.add_argument('--cnn_path', default='./resnet18.pth', type=str,
+                    help='Path to the frozen extractor weights')
+parser.add_argument('--mean', default=[0.485, 0.456, 0.406], type=float, nargs=3,
+                    help='Normalization mean of the model (NCF : 0.5 0.5 0.5)')
+parser.add_argument('--std', default=[0.229, 0.224, 0.225], type=float, nargs=3,
+                    help='Normalization std of the model (NCF : 0.5 0.5 0.5)')
+parser.add_argument('--dtype', default='float16', type=str,
+                    help='float16 or float32')
+parser.add_argument('--batch_size', default=256, type=int,
+                    help='images per forward')
+parser.add_argument('--workers', default=4, type=int,
+                    help='number of loading processes')
+parser.add_argument('--levels', action='store_true',
+                    help='Store the pooled maps of all 5 levels for --hier_attention')
+parser.add_argument('--name', default=None, type=str,
+                    help='file name of the bank (default : feature_bank, feature_bank_levels with --levels, '
+                         'NCF : feature_bank_ncf)')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str,
+                    help='device of the extractor')
+
+
+def item_images(data_path, mean, std):
+    # image of every item index, same source and preprocessing as load_data
+    if has_image_cache(data_path):
+        return load_image_cache(data_path, mean, std)
+    transform = transforms.Compose([transforms.Resize((224, 224)),
+                                    transforms.ToTensor(),
+                                    transforms.Normalize(mean=mean, std=std)])
+    if has_image_store(data_path):
+        return LazyImages(load_image_store(data_path), transform, budget=0)
+    with open(os.path.join(data_path, 'item_meta.json'), 'rb') as f:
+        meta_data = json.load(f)
+    paths = [os.path.abspath(os.path.join(data_path, meta_data[f'{item_id}']['image_path']))
+             for item_id in load_id_map(os.path.join(data_path, 'index-info'), 'item').keys.tolist()]
+    return LazyImages(paths, transform, budget=0)
+
+
+def level_channels(extractor):
+    # channels of the feature_list maps used by hierarchical_attention
+    return [extractor.conv1.out_channels, extractor.layer1[1].conv2.out_channels,
+            extractor.layer2[1].conv2.out_channels, extractor.layer3[1].conv2.out_channels,
+            extractor.layer4[1].conv2.out_channels]
+
+
+def main(args):
+    images = item_images(args.data_path, args.mean, args.std)
+    extractor = resnet_tv.resnet18()
+    extractor.load_state_dict(torch.load(args.cnn_path, map_location='cpu'))
+    extractor = extractor.to(args.device).eval()
+
+    # N x 512 penultimate features, or N x (64 + 64 + 128 + 256 + 512) globally average-pooled maps of
+    # feature_list with --levels, row = item index. written to a temporary file and renamed when complete
+    name = args.name or ('feature_bank_levels' if args.levels else 'feature_bank')
+    bank_path = os.path.join(args.data_path, f'{name}.npy')
+    width = sum(level_channels(extractor)) if args.levels else extractor.fc.in_features
+    bank = np.lib.format.open_memmap(bank_path + '.tmp', mode='w+', dtype=args.dtype, shape=(len(images), width))
+    loader = DataLoader(images, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+    start = 0
+    with torch.no_grad():
+        for image in loader:
+            _, feature = extractor.feature_list(image.to(args.device))
+            if args.levels:
+                feature = torch.cat([level.mean((2, 3)) for level in feature[:-1]], 1)
+            else:
+                feature = feature[5]
+            bank[start:start + len(image)] = feature.cpu().numpy()
+            start += len(image)
+            print(f'{start}/{len(images)} items')
+    bank.flush()
+    del bank
+    os.replace(bank_path + '.tmp', bank_path)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
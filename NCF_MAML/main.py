@@ -12,7 +12,8 @@ from utils import Logger, AverageMeter, str2bool
 from model import MAML, NeuralCF
 from loss import Embedding_loss, Feature_loss, Covariance_loss
 import dataset as D
-from metric import get_performance
+from storage import share_memory
+from metric import batch_performance
 import resnet_tv as resnet
 import torch.distributed as dist
 import torchvision.utils as vutils
@@ -52,6 +53,10 @@ parser.add_argument('--eval_freq', default=10, type=int,
                     help='evaluate performance every n epoch')
 parser.add_argument('--feature_type', default='rating', type=str,
                     help='Type of feature to use. [all, img, txt, rating]')
+parser.add_argument('--feature_data_type', default='raw', type=str,
+                    help='raw(png) or pre(vector, feature_bank.py)')
+parser.add_argument('--sampling', default='uniform', type=str,
+                    help='negative sampling, uniform or popularity(train degree)')
 parser.add_argument('--eval_type', default='ratio-split', type=str,
                     help='Evaluation protocol. [ratio-split, leave-one-out]')
 parser.add_argument('--cnn_path', default='./resnet18.pth', type=str,
@@ -69,9 +74,15 @@ parser.add_argument('--mode', default='train', type=str,
 parser.add_argument('--att_type', default=None, type=str)
 parser.add_argument('--att_wd', default=0.1, type=float)
 args = parser.parse_args()
+if args.feature_data_type == 'pre' and args.hier_attention and args.att_type == 'BAM':
+    # the level bank holds pooled maps, BAM works on the full maps
+    parser.error('--att_type BAM needs --feature_data_type raw with --hier_attention')
+if args.feature_data_type == 'pre' and args.fine_tuning:
+    # the bank was produced by the frozen extractor
+    parser.error('--fine_tuning needs --feature_data_type raw')
 
 
-def main(rank, args):
+def main(rank, args, data):
     # Initialize Each Process
     init_process(rank, args.world_size)
 
@@ -83,11 +94,8 @@ def main(rank, args):
         with open(save_path + '/configuration.json', 'w') as f:
             json.dump(args.__dict__, f, indent=2)
 
-    # Load dataset
-    print("Loading Dataset")
-    data_path = os.path.join(args.data_path, args.eval_type)
-    train_df, val_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images, test_pos_item_num, item_num_dict = D.load_data(
-        data_path, args.feature_type)
+    # Dataset loaded once before the ranks were forked
+    train_df, val_df, test_df, train_ng_pool, test_negative, num_user, num_item, text_feature, images, test_candidates, val_candidates = data
     train_dataset = D.CustomDataset(args.model, train_df, text_feature, images, negative=train_ng_pool,
                                     num_neg=args.num_neg, istrain=True, feature_type=args.feature_type)
     val_dataset = D.CustomDataset(args.model, val_df, text_feature, images, negative=test_negative, num_neg=None,
@@ -101,22 +109,24 @@ def main(rank, args):
                                                                     rank=rank,
                                                                     num_replicas=args.world_size,
                                                                     shuffle=True)
+    # The datasets return whole batches as tensors (CustomDataset.__getitems__).
     train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=2,
-                              collate_fn=my_collate_trn, pin_memory=True, sampler=train_sampler)
+                              collate_fn=D.collate_batch, pin_memory=True, sampler=train_sampler)
     val_loader = DataLoader(val_dataset, batch_size=int(args.batch_size / 4), shuffle=False, num_workers=2,
-                             collate_fn=my_collate_tst, pin_memory=True)
+                             collate_fn=D.collate_batch, pin_memory=True)
     test_loader = DataLoader(test_dataset, batch_size=int(args.batch_size / 4), shuffle=False, num_workers=2,
-                             collate_fn=my_collate_tst, pin_memory=True)
+                             collate_fn=D.collate_batch, pin_memory=True)
 
     # Model
     t_feature_dim = 300
     if args.model == 'MAML':
         model = MAML(num_user, num_item, args.embed_dim, args.dropout_rate, args.feature_type, t_feature_dim,
-                     args.cnn_path, args.fine_tuning, rank, args.att_type, args.hier_attention).cuda(rank)
+                     args.cnn_path, args.fine_tuning, rank, args.att_type, args.hier_attention,
+                     args.feature_data_type).cuda(rank)
     else:
         model = NeuralCF(num_users=num_user, num_items=num_item,
                          embedding_size=args.embed_dim, dropout=args.dropout_rate,
-                         num_layers=args.num_layers, feature_type=args.feature_type, text=t_feature_dim,
+                         num_layers=args.num_layers, feature_data_type=args.feature_data_type, feature_type=args.feature_type, text=t_feature_dim,
                          extractor_path=args.cnn_path, rank=rank, fine_tuning=args.fine_tuning, att_type=args.att_type).cuda(rank)
 
     model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank]) # , find_unused_parameters=True 
@@ -165,7 +175,7 @@ def main(rank, args):
         epoch = 50000
         if dist.get_rank() == 0:
             test(model=model, model_type=args.model, test_loader=test_loader, test_logger=test_logger, epoch=epoch, 
-                test_pos_item_num=test_pos_item_num, item_num_dict=item_num_dict, hier_attention=args.hier_attention)
+                candidates=test_candidates, hier_attention=args.hier_attention)
             print('test time : ', time.time() - start, 'sec/epoch => ', (time.time() - start) / 60, 'min')
 
     # Train & Eval
@@ -190,7 +200,7 @@ def main(rank, args):
                 if dist.get_rank() == 0:
                     torch.save(model.state_dict(), f"{save_path}/model_{epoch + 1}.pth")
                     test(model=model, model_type=args.model, test_loader=val_loader, test_logger=val_logger, epoch=epoch,
-                        test_pos_item_num=test_pos_item_num, item_num_dict=item_num_dict, hier_attention=args.hier_attention)
+                        candidates=val_candidates, hier_attention=args.hier_attention)
                     print('validation time : ', time.time() - start, 'sec/epoch => ', (time.time() - start) / 60, 'min')
         
     cleanup()
@@ -215,7 +225,11 @@ def train(model, model_type, optimizer, scaler, train_loader, train_logger, epoc
         data_time.update(time.time() - end)
         optimizer.zero_grad()
         with torch.cuda.amp.autocast():
-            if model_type == "MAML":
+            if model_type == "MAML" and args.feature_type == "rating":
+                user, item_p, item_n = [x.cuda(dist.get_rank()) for x in data]
+                a_u, a_i, a_i_feature, dist_a = model(user, torch.hstack([item_p.unsqueeze(1), item_n]), None, None,
+                                                      kwargs['hier_attention'])
+            elif model_type == "MAML":
                 (user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n) = data
                 user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n = user.cuda(dist.get_rank()), item_p.cuda(
                     dist.get_rank()), \
@@ -230,6 +244,9 @@ def train(model, model_type, optimizer, scaler, train_loader, train_logger, epoc
                                                       torch.hstack([t_feature_p.unsqueeze(1), t_feature_n]),
                                                       torch.hstack([img_p.unsqueeze(1), img_n]),
                                                       kwargs['hier_attention'])
+            elif args.feature_type == "rating":  # NCF
+                user, item, rating = [x.view(-1).cuda(dist.get_rank()) for x in data]
+                score = model(user, item, feature_type=args.feature_type, hier_attention=kwargs['hier_attention'])
             else:  # NCF
                 (user, item, rating, t_feature, img) = data
                 user, item, rating, t_feature, img = user.cuda(dist.get_rank()), item.cuda(dist.get_rank()), \
@@ -294,7 +311,7 @@ def train(model, model_type, optimizer, scaler, train_loader, train_logger, epoc
             train_logger.write([epoch, total_loss.avg])
 
 
-def test(model, model_type, test_loader, test_logger, epoch, test_pos_item_num, item_num_dict, **kwargs):
+def test(model, model_type, test_loader, test_logger, epoch, candidates, **kwargs):
     model.eval()
     hr_1 = AverageMeter()
     hr2_1 = AverageMeter()
@@ -311,110 +328,61 @@ def test(model, model_type, test_loader, test_logger, epoch, test_pos_item_num,
     data_time = AverageMeter()
     iter_time = AverageMeter()
     k = [1, 10]
-    
-    score_cat = torch.tensor([]).cuda(dist.get_rank())
+
+    # Scores of the padded candidate matrix, the padding is never recommended
+    fill = float('inf') if model_type == "MAML" else -float('inf')
+    scores = torch.full(candidates.items.shape, fill).cuda(dist.get_rank())
+    flat_index = torch.from_numpy(candidates.flat_index()).cuda(dist.get_rank())
+    start = 0
 
     end = time.time()
-    user_count = 0
-    for i, (user, item, feature, image) in enumerate(test_loader):
+    for i, data in enumerate(test_loader):
         data_time.update(time.time() - end)
         with torch.no_grad():
-            user, item, feature, image = user.squeeze(-1), item.squeeze(-1), feature.squeeze(-1), image.squeeze(-1)
-            user, item, feature, image = \
-                user.cuda(dist.get_rank(), non_blocking=True), item.cuda(dist.get_rank(), non_blocking=True), \
-                feature.cuda(dist.get_rank(), non_blocking=True), image.cuda(dist.get_rank(), non_blocking=True)
+            # (user, item) for rating only, (user, item, feature, image) otherwise
+            data = [x.cuda(dist.get_rank(), non_blocking=True) for x in data]
+            user, item = data[0].view(-1), data[1].view(-1)
+            feature, image = (data[2].squeeze(-1), data[3].squeeze(-1)) if len(data) == 4 else (None, None)
             if model_type == "MAML":
                 _, _, _, score = model(user, item, feature, image, kwargs['hier_attention'])
             else:  # NCF
                 score = model(user, item, image=image, text=feature, feature_type=args.feature_type,
                               hier_attention=kwargs['hier_attention'])
-        
-            score_cat = torch.cat((score_cat, score))
+
+            scores.view(-1)[flat_index[start:start + len(score)]] = score.float()
+            start += len(score)
 
             if (i % 500) == 0 and (dist.get_rank() == 0):
                 print(f"test iter : {i}/{len(test_loader)}")
-
-            while (len(score_cat) >= item_num_dict[user_count]):
-                score_sub_tensor = score_cat[:item_num_dict[user_count]]
-                score_cat = score_cat[item_num_dict[user_count]:]
-                for i in k:
-                    if model_type == "MAML":
-                        _, indices = torch.topk(-score_sub_tensor, i)
-                    else:  # NCF
-                        _, indices = torch.topk(score_sub_tensor, i)
-                    recommends = indices
-                    gt_item = torch.tensor(range(test_pos_item_num[user_count])).cuda(dist.get_rank())
-                    performance = get_performance(gt_item, recommends)
-                    performance = torch.tensor(performance).cuda(dist.get_rank())
-                    if i == 1:
-                        hr_1.update(performance[0])
-                        hr2_1.update(performance[1])
-                        ndcg_1.update(performance[2])
-                    else:
-                        hr_10.update(performance[0])
-                        hr2_10.update(performance[1])
-                        ndcg_10.update(performance[2])
-                user_count += 1
-                iter_time.update(time.time() - end)
-                end = time.time()
-                if user_count == len(item_num_dict.keys()):
-                    break
+        iter_time.update(time.time() - end)
+        end = time.time()
+
+    # Top-k and metrics of blocks of users as tensor ops
+    positive = torch.from_numpy(candidates.positive()).cuda(dist.get_rank())
+    num_pos = torch.from_numpy(np.array(candidates.num_pos)).cuda(dist.get_rank())
+    for block in range(0, len(candidates), 1024):
+        rows = slice(block, block + 1024)
+        for i in k:
+            performance = batch_performance(scores[rows], positive[rows], num_pos[rows], i,
+                                            largest=model_type != "MAML")
+            n = len(performance[0])
+            if i == 1:
+                hr_1.update(performance[0].mean(), n)
+                hr2_1.update(performance[1].mean(), n)
+                ndcg_1.update(performance[2].mean(), n)
+            else:
+                hr_10.update(performance[0].mean(), n)
+                hr2_10.update(performance[1].mean(), n)
+                ndcg_10.update(performance[2].mean(), n)
 
     if dist.get_rank() == 0:
         print(
-            f"{user_count} Users tested. Iteration time : {iter_time.avg:.5f}/user Data time : {data_time.avg:.5f}/user")
+            f"{len(candidates)} Users tested. Iteration time : {iter_time.avg:.5f}/iter Data time : {data_time.avg:.5f}/iter")
         print(
-            f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr_10.avg:.4f} nDCG : {ndcg_10.avg:.4f} Hit Ratio 2 : {hr2_10.avg:.4f} Test Time : {iter_time.avg:.4f}/user")
+            f"Epoch : [{epoch + 1}/{args.epoch}] Hit Ratio : {hr_10.avg:.4f} nDCG : {ndcg_10.avg:.4f} Hit Ratio 2 : {hr2_10.avg:.4f} Test Time : {iter_time.avg:.4f}/iter")
         test_logger.write(
             [epoch, float(hr_1.avg), float(hr2_1.avg), float(ndcg_1.avg), float(hr_10.avg), float(hr2_10.avg), float(ndcg_10.avg)])
 
-            
-def my_collate_trn(batch):
-    # MAML
-    if len(batch[0]) == 7:
-        user = [item[0] for item in batch]
-        user = torch.LongTensor(user)
-        item_p = [item[1] for item in batch]
-        item_p = torch.LongTensor(item_p)
-        item_n = [item[2] for item in batch]
-        item_n = torch.LongTensor(item_n)
-        t_feature_p = [item[3] for item in batch]
-        t_feature_p = torch.FloatTensor(t_feature_p)
-        t_feature_n = [item[4] for item in batch]
-        t_feature_n = torch.FloatTensor(t_feature_n)
-        img_p = [item[5] for item in batch]
-        img_p = torch.stack(img_p)
-        img_n = [item[6] for item in batch]
-        img_n = torch.stack(img_n)
-
-        return [user, item_p, item_n, t_feature_p, t_feature_n, img_p, img_n]
-    # NCF
-    else:
-        user = [element for item in batch for element in item[0]]
-        user = torch.LongTensor(user)
-        items = [element for item in batch for element in item[1]]
-        items = torch.LongTensor(items)
-        rating = [element for item in batch for element in item[2]]
-        rating = torch.FloatTensor(rating)
-        t_feature = [element for item in batch for element in item[3]]
-        t_feature = torch.FloatTensor(t_feature)
-        img = [element for item in batch for element in item[4]]
-        img = torch.stack(img)
-
-        return [user, items, rating, t_feature, img]
-
-
-def my_collate_tst(batch):
-    user = [items[0] for items in batch]
-    user = torch.LongTensor(user)
-    item = [items[1] for items in batch]
-    item = torch.LongTensor(item)
-    t_feature = [items[2] for items in batch]
-    t_feature = torch.FloatTensor(t_feature)
-    img = [items[3] for items in batch]
-    img = torch.stack(img)
-    return [user, item, t_feature, img]
-
 
 def init_process(rank, world_size, backend='nccl'):
     os.environ['MASTER_ADDR'] = args.ddp_addr
@@ -436,4 +404,8 @@ def cleanup():
 
 if __name__ == "__main__":
     args.world_size = torch.cuda.device_count()
-    mp.spawn(main, nprocs=args.world_size, args=(args,))
+    # Load dataset once. The ranks are forked and read it from shared memory / memory-mapped files.
+    print("Loading Dataset")
+    data = share_memory(D.load_data(os.path.join(args.data_path, args.eval_type), args.feature_type, args.feature_data_type,
+                                    args.hier_attention, args.sampling))
+    mp.start_processes(main, nprocs=args.world_size, args=(args, data), start_method='fork')
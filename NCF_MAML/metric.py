@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 def get_performance(gt_item, recommends):
     '''
@@ -33,3 +34,22 @@ def get_performance(gt_item, recommends):
     ndcg = dcg / idcg
 
     return hr1, hr2, ndcg
+
+
+def batch_performance(scores, positive, num_pos, k, largest=True):
+    '''
+    get_performance of a block of users at once
+    scores(torch.Tensor) : [users x candidates] scores, padding -inf (+inf if not largest)
+    positive(torch.Tensor) : [users x candidates] ground truth mask
+    num_pos(torch.Tensor) : [users] number of ground truth items
+    -> hr1, hr2, ndcg of every user
+    '''
+    _, recommends = torch.topk(scores, k, dim=1, largest=largest)
+    hit = positive.gather(1, recommends).float()
+    discount = 1. / torch.log2(torch.arange(k, device=scores.device) + 2.)
+    num_gt = torch.clamp(num_pos, max=k)
+
+    hr1 = (hit.sum(1) > 0).float()
+    hr2 = hit.sum(1) / num_gt
+    ndcg = (hit * discount).sum(1) / torch.cumsum(discount, 0)[num_gt - 1]
+    return hr1, hr2, ndcg
@@ -7,6 +7,9 @@ import torch.nn.functional as F
 import resnet_tv
 from bam import *
 
+# channels of the resnet18 feature_list levels (conv1, layer1-4), the last one is the penultimate feature dim
+RESNET18_CHANNELS = [64, 64, 128, 256, 512]
+
 
 class NeuralCF(nn.Module):
     def __init__(self, num_users, num_items, embedding_size, dropout, num_layers, att_type, **kwargs):
@@ -15,6 +18,7 @@ class NeuralCF(nn.Module):
         self.item_embedding_gmf = nn.Embedding(num_items, embedding_size)
         self.user_embedding_mlp = nn.Embedding(num_users, embedding_size)
         self.item_embedding_mlp = nn.Embedding(num_items, embedding_size)
+        self.feature_data_type = kwargs.get('feature_data_type', 'raw')
 
         # for bam
         self.att_type = att_type
@@ -28,16 +32,22 @@ class NeuralCF(nn.Module):
         if (kwargs['feature_type'] == 'img') | (kwargs['feature_type'] == 'all'):
             print("IMAGE FEATURE")
 
-            self.v_feature_extractor = resnet_tv.resnet18()
-            self.v_feature_extractor.load_state_dict(
-                torch.load(kwargs['extractor_path'], map_location='cuda:%d' % kwargs['rank']))
+            # the extractor is not built for pre features of feature_bank.py
+            if self.feature_data_type == 'raw':
+                self.v_feature_extractor = resnet_tv.resnet18()
+                self.v_feature_extractor.load_state_dict(
+                    torch.load(kwargs['extractor_path'], map_location='cuda:%d' % kwargs['rank']))
+                if kwargs['fine_tuning'] == False:
+                    self.v_feature_extractor.eval()
+                    for param in self.v_feature_extractor.parameters():
+                        param.requires_grad = False
+            else:
+                self.v_feature_extractor = None
             # attention을 위한 field들
-            self.v_feature_dim = self.v_feature_extractor.fc.in_features
-            self.v_feature_c1 = self.v_feature_extractor.conv1.out_channels
-            self.v_feature_c2 = self.v_feature_extractor.layer1[1].conv2.out_channels
-            self.v_feature_c3 = self.v_feature_extractor.layer2[1].conv2.out_channels
-            self.v_feature_c4 = self.v_feature_extractor.layer3[1].conv2.out_channels
-            self.v_feature_c5 = self.v_feature_extractor.layer4[1].conv2.out_channels
+            self.v_feature_c1, self.v_feature_c2, self.v_feature_c3, self.v_feature_c4, self.v_feature_c5 = \
+                RESNET18_CHANNELS
+            self.v_feature_dim = self.v_feature_c5
+            self.v_feature_levels = list(RESNET18_CHANNELS)
 
             self.conv_key1 = nn.Conv2d(self.v_feature_c1, embedding_size * 2, 1)
             self.conv_key2 = nn.Conv2d(self.v_feature_c2, embedding_size * 2, 1)
@@ -50,13 +60,9 @@ class NeuralCF(nn.Module):
             self.conv_value3 = nn.Conv2d(self.v_feature_c3, self.v_feature_dim, 1)
             self.conv_value4 = nn.Conv2d(self.v_feature_c4, self.v_feature_dim, 1)
             self.cnov_value5 = nn.Conv2d(self.v_feature_c5, self.v_feature_dim, 1)
-            if kwargs['fine_tuning'] == False:
-                self.v_feature_extractor.eval()
-                for param in self.v_feature_extractor.parameters():
-                    param.requires_grad = False
 
             self.image_embedding = []
-            self.image_embedding.append(nn.Linear(self.v_feature_extractor.fc.in_features, 256))
+            self.image_embedding.append(nn.Linear(self.v_feature_dim, 256))
             self.image_embedding.append(nn.BatchNorm1d(256))
             self.image_embedding.append(nn.ReLU())
             self.image_embedding.append(nn.Linear(256, 128))
@@ -133,9 +139,13 @@ class NeuralCF(nn.Module):
             item_embedding = item_embedding.reshape(item_embedding.size(0) * item_embedding.size(1),
                                                     item_embedding.size(2))
         user_embedding = torch.cat([user_embedding, item_embedding], 1)
-        _, feature_map = v_feature_extractor.feature_list(image)
-        feature_map = self.bam_attention(feature_map)
-        feature_map = feature_map[:-1]
+        if self.feature_data_type == 'pre':
+            # pooled maps of the 5 levels from feature_bank.py --levels, as 1 x 1 maps
+            feature_map = [level[..., None, None] for level in torch.split(image, self.v_feature_levels, dim=-1)]
+        else:
+            _, feature_map = v_feature_extractor.feature_list(image)
+            feature_map = self.bam_attention(feature_map)
+            feature_map = feature_map[:-1]
         score = []
         for i in range(len(feature_map)):
             key = key_modules[i](nn.AvgPool2d(feature_map[i].size(-1))(feature_map[i]))
@@ -167,6 +177,8 @@ class NeuralCF(nn.Module):
                                                     kwargs['image'],
                                                     user_mlp, item_mlp)
                 image = self.image_embedding(image)
+            elif self.feature_data_type == 'pre':
+                image = self.image_embedding(kwargs['image'])
             else:
                 _, image = self.v_feature_extractor.feature_list(kwargs['image'])
                 image = self.bam_attention(image)
@@ -186,7 +198,7 @@ class NeuralCF(nn.Module):
 
 class MAML(nn.Module):
     def __init__(self, n_users, n_items, embed_dim, dropout_rate, feature_type, t_feature_dim,
-                 v_feature_extractor_path, fine_tuning, rank, att_type, hier_att):
+                 v_feature_extractor_path, fine_tuning, rank, att_type, hier_att, feature_data_type='raw'):
         super(MAML, self).__init__()
         self.embed_dim = embed_dim
         self.n_users = n_users
@@ -196,42 +208,44 @@ class MAML(nn.Module):
         self.t_feature_dim = t_feature_dim
         self.rank = rank
         self.att_type = att_type
+        self.feature_data_type = feature_data_type
 
         # Embedding Layers
         self.embedding_user = nn.Embedding(n_users, embed_dim, max_norm=1.0)
         self.embedding_item = nn.Embedding(n_items, embed_dim, max_norm=1.0)
 
-        # Image feature extractor module
-        self.v_feature_extractor = resnet_tv.resnet18()
-        self.v_feature_dim = self.v_feature_extractor.fc.in_features
-        self.v_feature_c1 = self.v_feature_extractor.conv1.out_channels
-        self.v_feature_c2 = self.v_feature_extractor.layer1[1].conv2.out_channels
-        self.v_feature_c3 = self.v_feature_extractor.layer2[1].conv2.out_channels
-        self.v_feature_c4 = self.v_feature_extractor.layer3[1].conv2.out_channels
-        self.v_feature_c5 = self.v_feature_extractor.layer4[1].conv2.out_channels
-
-        if v_feature_extractor_path is not None:
-            self.v_feature_extractor.load_state_dict(
-                torch.load(v_feature_extractor_path, map_location='cuda:%d' % self.rank))
-
-        if fine_tuning is False:
-            self.v_feature_extractor.eval()
-            for param in self.v_feature_extractor.parameters():
-                param.requires_grad = False
-        
-        if hier_att:
-            # For attention Layers
-            self.conv_key1 = nn.Conv2d(self.v_feature_c1, self.embed_dim * 2, 1)
-            self.conv_key2 = nn.Conv2d(self.v_feature_c2, self.embed_dim * 2, 1)
-            self.conv_key3 = nn.Conv2d(self.v_feature_c3, self.embed_dim * 2, 1)
-            self.conv_key4 = nn.Conv2d(self.v_feature_c4, self.embed_dim * 2, 1)
-            self.conv_key5 = nn.Conv2d(self.v_feature_c5, self.embed_dim * 2, 1)
-
-            self.conv_value1 = nn.Conv2d(self.v_feature_c1, self.v_feature_dim, 1)
-            self.conv_value2 = nn.Conv2d(self.v_feature_c2, self.v_feature_dim, 1)
-            self.conv_value3 = nn.Conv2d(self.v_feature_c3, self.v_feature_dim, 1)
-            self.conv_value4 = nn.Conv2d(self.v_feature_c4, self.v_feature_dim, 1)
-            self.cnov_value5 = nn.Conv2d(self.v_feature_c5, self.v_feature_dim, 1)
+        # Image feature extractor module, only for image features and not for pre features of feature_bank.py
+        if self.feature_type == "img" or self.feature_type == "all":
+            self.v_feature_c1, self.v_feature_c2, self.v_feature_c3, self.v_feature_c4, self.v_feature_c5 = \
+                RESNET18_CHANNELS
+            self.v_feature_dim = self.v_feature_c5
+            self.v_feature_levels = list(RESNET18_CHANNELS)
+            if self.feature_data_type == 'raw':
+                self.v_feature_extractor = resnet_tv.resnet18()
+                if v_feature_extractor_path is not None:
+                    self.v_feature_extractor.load_state_dict(
+                        torch.load(v_feature_extractor_path, map_location='cuda:%d' % self.rank))
+
+                if fine_tuning is False:
+                    self.v_feature_extractor.eval()
+                    for param in self.v_feature_extractor.parameters():
+                        param.requires_grad = False
+            else:
+                self.v_feature_extractor = None
+
+            if hier_att:
+                # For attention Layers
+                self.conv_key1 = nn.Conv2d(self.v_feature_c1, self.embed_dim * 2, 1)
+                self.conv_key2 = nn.Conv2d(self.v_feature_c2, self.embed_dim * 2, 1)
+                self.conv_key3 = nn.Conv2d(self.v_feature_c3, self.embed_dim * 2, 1)
+                self.conv_key4 = nn.Conv2d(self.v_feature_c4, self.embed_dim * 2, 1)
+                self.conv_key5 = nn.Conv2d(self.v_feature_c5, self.embed_dim * 2, 1)
+
+                self.conv_value1 = nn.Conv2d(self.v_feature_c1, self.v_feature_dim, 1)
+                self.conv_value2 = nn.Conv2d(self.v_feature_c2, self.v_feature_dim, 1)
+                self.conv_value3 = nn.Conv2d(self.v_feature_c3, self.v_feature_dim, 1)
+                self.conv_value4 = nn.Conv2d(self.v_feature_c4, self.v_feature_dim, 1)
+                self.cnov_value5 = nn.Conv2d(self.v_feature_c5, self.v_feature_dim, 1)
 
         if self.att_type == 'BAM':
             self.bam1 = BAM(64)
@@ -301,9 +315,13 @@ class MAML(nn.Module):
             item_embedding = item_embedding.reshape(item_embedding.size(0) * item_embedding.size(1),
                                                     item_embedding.size(2))
         user_embedding = torch.cat([user_embedding, item_embedding], 1)
-        _, feature_map = v_feature_extractor.feature_list(image)
-        feature_map = self.bam_attention(feature_map)
-        feature_map = feature_map[:-1]
+        if self.feature_data_type == 'pre':
+            # pooled maps of the 5 levels from feature_bank.py --levels, as 1 x 1 maps
+            feature_map = [level[..., None, None] for level in torch.split(image, self.v_feature_levels, dim=-1)]
+        else:
+            _, feature_map = v_feature_extractor.feature_list(image)
+            feature_map = self.bam_attention(feature_map)
+            feature_map = feature_map[:-1]
         score = []
         for i in range(len(feature_map)):
             key = key_modules[i](nn.AvgPool2d(feature_map[i].size(-1))(feature_map[i]))
@@ -321,8 +339,11 @@ class MAML(nn.Module):
         return attention_matrix
 
     def forward(self, user, item, t_feature, image, hier_attention):
-        key_modules = [self.conv_key1, self.conv_key2, self.conv_key3, self.conv_key4, self.conv_key5]
-        value_modules = [self.conv_value1, self.conv_value2, self.conv_value3, self.conv_value4, self.cnov_value5]
+        # the attention convs exist only with image features
+        hier_attention = hier_attention and (self.feature_type == "img" or self.feature_type == "all")
+        if hier_attention:
+            key_modules = [self.conv_key1, self.conv_key2, self.conv_key3, self.conv_key4, self.conv_key5]
+            value_modules = [self.conv_value1, self.conv_value2, self.conv_value3, self.conv_value4, self.cnov_value5]
 
         # Embed user, item
         p_u = self.embedding_user(user)
@@ -338,6 +359,8 @@ class MAML(nn.Module):
             if hier_attention:
                 v_feature = self.hierarchical_attention(self.v_feature_extractor, key_modules, value_modules, image,
                                                         p_u, q_i)
+            elif self.feature_data_type == 'pre':
+                v_feature = image
             else:
                 _, v_feature = self.v_feature_extractor.feature_list(image)
                 v_feature = self.bam_attention(v_feature)
@@ -350,6 +373,8 @@ class MAML(nn.Module):
             if hier_attention:
                 v_feature = self.hierarchical_attention(self.v_feature_extractor, key_modules, value_modules, image,
                                                         p_u, q_i)
+            elif self.feature_data_type == 'pre':
+                v_feature = image
             else:
                 _, v_feature = self.v_feature_extractor.feature_list(image)
                 v_feature = self.bam_attention(v_feature)
@@ -1,77 +1,661 @@
-import os
-import pandas as pd
-import numpy as np
-import argparse
-import random
-
-parser = argparse.ArgumentParser(description='data_split')
-parser.add_argument('--data_path', default='./Amazon-office-raw/ratings.csv', type=str,
-                    help='datapath')
-parser.add_argument('--save_path', default='./Amazon-office-raw', type=str,
-                    help='savepath')
-parser.add_argument('--negative_sampling', default=True, type=bool,
-                    help='test negative sampling')
-args = parser.parse_args()
-random.seed(1)
-
-ratings=pd.read_csv(args.data_path)
-type=['ratio-split','leave-one-out']
-# indexing user
-user_id=ratings[['userid']].drop_duplicates().reset_index(drop=True)
-user_id['useridx']=pd.DataFrame(np.arange(len(user_id)))
-userdict=dict(zip(user_id['userid'],user_id['useridx']))
-ratings=ratings.replace({'userid':userdict})
-
-#indexing item
-item_id=ratings[['itemid']].drop_duplicates().reset_index(drop=True)
-item_id['itemidx']=pd.DataFrame(np.arange(len(item_id)))
-itemdict=dict(zip(item_id['itemid'],item_id['itemidx']))
-ratings=ratings.replace({'itemid':itemdict})
-
-# group items according to user index
-items_set=set(item_id['itemidx'])
-#ratings['rate'][ratings['rate']>0]=1.0
-rating1=ratings.groupby('userid')['itemid'].apply(list).reset_index()
-rating2=ratings.groupby('userid')['timestamp'].apply(list).reset_index()
-
-# split
-for split_type in type:
-    ratings = pd.concat([rating1[['userid', 'itemid']], rating2['timestamp']], axis=1)
-    if split_type=='leave-one-out':
-        ratings['test_positive_index']=ratings['timestamp'].apply(lambda x: np.array(x).argmax())
-        ratings['test_positive']=ratings.apply(lambda x: x['itemid'][x['test_positive_index']], axis=1)
-        ratings['negative']=ratings['itemid'].apply(lambda x: list(items_set - set(x)))
-        ratings['test_negative']=ratings['negative'].apply(lambda x: random.sample(x, 99))
-        ratings['train_negative']=ratings.apply(lambda x: list(items_set - set(x['itemid']) - set(x['test_negative'])), axis=1)
-        ratings.apply(lambda x: x['itemid'].remove(x['test_positive']), axis=1)
-
-
-    elif split_type=='ratio-split':
-        ratings['test_positive']=ratings['itemid'].apply(lambda x: random.sample(x, round(len(x)*0.2)))
-        ratings['itemid']=ratings.apply(lambda x: list(set(x['itemid'])-set(x['test_positive'])), axis=1)
-        ratings['train_negative']=ratings.apply(lambda x: list(items_set - set(x['itemid'])),axis=1)
-        if args.negative_sampling:
-            ratings['test_negative']=ratings.apply(lambda x: random.sample(list(items_set - set(x['itemid'])- set(x['test_positive'])),len(x['test_positive']*10))
-                                                if len(x['test_positive'])*10 <= len(list(items_set-set(x['itemid'])-set(x['test_positive']))) else list(items_set - set(x['itemid'])- set(x['test_positive'])), axis=1)
-
-        else :
-            ratings['test_negative']=ratings.apply(lambda x: list(items_set - set(x['itemid'])- set(x['test_positive'])), axis=1)
-        ratings['train_negative'] = ratings.apply(lambda x: list(set(x['train_negative'])-set(x['test_negative'])), axis=1)
-
-    ratings.rename(columns = {'itemid':'train_positive'}, inplace = True)
-    ratings = ratings[['userid','train_positive','test_positive','train_negative', 'test_negative']].reset_index(drop=True)
-    train_positive=ratings.join(ratings['train_positive'].apply(lambda x:pd.Series(x)).stack().reset_index(1,name='train_pos').drop('level_1',axis=1))
-    test_positive=ratings.join(ratings['test_positive'].apply(lambda x:pd.Series(x)).stack().reset_index(1,name='test_pos').drop('level_1',axis=1))
-
-    # save
-    if not os.path.exists(os.path.join(args.save_path, split_type)):
-        os.makedirs(os.path.join(args.save_path, split_type))
-    train_positive[['userid','train_pos']].reset_index(drop=True).to_feather(os.path.join(args.save_path,split_type, 'train_positive.ftr'))
-    test_positive[['userid','test_pos']].reset_index(drop=True).to_feather(os.path.join(args.save_path,split_type, 'test_positive.ftr'))
-    ratings[['userid','train_negative']].reset_index(drop=True).to_feather(os.path.join(args.save_path,split_type, 'train_negative.ftr'))
-    ratings[['userid','test_negative']].reset_index(drop=True).to_feather(os.path.join(args.save_path,split_type, 'test_negative.ftr'))
-
-if not os.path.exists(os.path.join(args.save_path,'index-info')):
-    os.makedirs(os.path.join(args.save_path,'index-info'))
-user_id.to_csv(os.path.join(args.save_path,'index-info', 'user_index.csv'),index=False)
-item_id.to_csv(os.path.join(args.save_path,'index-info', 'item_index.csv'),index=False)
+import os
+import json
+import shutil
+import zlib
+from multiprocessing import Pool
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import argparse
+
+parser = argparse.ArgumentParser(description='data_split')
+parser.add_argument('--data_path', default='./Amazon-office-raw/ratings.csv', type=str,
+                    help='datapath')
+parser.add_argument('--save_path', default='./Amazon-office-raw', type=str,
+                    help='savepath')
+parser.add_argument('--negative_sampling', default=True, type=bool,
+                    help='test negative sampling')
+parser.add_argument('--validation', action='store_true',
+                    help='hold out validation positives (val_positive) from the train positives')
+parser.add_argument('--seed', default=1, type=int,
+                    help='random seed')
+parser.add_argument('--save_format', default='ftr', type=str,
+                    help='ftr(feather with negative lists) or csr(positives-only indptr/indices npy)')
+parser.add_argument('--chunk_size', default=0, type=int,
+                    help='rows per chunk for streaming ingestion. 0 reads the whole file at once')
+parser.add_argument('--bucket_users', default=1 << 20, type=int,
+                    help='users per spilled block in streaming ingestion')
+parser.add_argument('--workers', default=1, type=int,
+                    help='number of processes splitting user shards')
+parser.add_argument('--kcore', default=0, type=int,
+                    help='keep only users and items with at least kcore ratings in the filtered data. 0 keeps all')
+parser.add_argument('--delta_path', default='', type=str,
+                    help='new ratings to add to the csr split already in save_path. empty splits data_path from scratch')
+
+# number of boolean cells materialized at once when building complement lists
+BLOCK_CELLS = 1 << 26
+SPLIT_TYPES = ['ratio-split', 'leave-one-out']
+# part of every interaction
+TRAIN, TEST, VAL = 0, 1, 2
+
+
+def index_ratings(ratings):
+    # index users/items in order of first appearance
+    user, user_ids = pd.factorize(ratings['userid'])
+    item, item_ids = pd.factorize(ratings['itemid'])
+    return user.astype(np.int64), item.astype(np.int64), np.asarray(user_ids), np.asarray(item_ids)
+
+
+def mix(x):
+    # splitmix64 finalizer on uint64 arrays
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class UserRandom(object):
+    '''
+    Counter based random numbers. Draw k of user u is a hash of (seed, stream, u, k),
+    so the result of a user does not depend on which shard or process splits it.
+    '''
+
+    def __init__(self, seed, stream):
+        self.key = mix(mix(np.array([seed], dtype=np.uint64)) + np.uint64(zlib.crc32(stream.encode())))
+
+    def bits(self, users, counters):
+        return mix(mix(self.key + users.astype(np.uint64)) + counters.astype(np.uint64)) >> np.uint64(11)
+
+    def random(self, users, counters):
+        return self.bits(users, counters) * 2.0 ** -53
+
+    def integers(self, users, counters, high):
+        return (self.bits(users, counters) % np.uint64(high)).astype(np.int64)
+
+
+def encode(values, index):
+    # map raw ids to indices, appending unseen ids in order of first appearance.
+    # only the uniques of the chunk are looked up in index
+    codes, uniques = pd.factorize(values)
+    indices = np.array([index.setdefault(key, len(index)) for key in uniques.tolist()], dtype=np.int64)
+    return indices[codes]
+
+
+def stream_ratings(data_path, chunk_size, spill_dir, bucket_users):
+    '''
+    Read ratings chunk by chunk, index users/items incrementally and spill the
+    (user, item, timestamp) rows of every block of bucket_users users to spill_dir.
+    Return the spilled runs as (block, path) in reading order and the raw ids of every user/item index.
+    '''
+    user_index, item_index = {}, {}
+    runs = []
+    for n, chunk in enumerate(pd.read_csv(data_path, chunksize=chunk_size)):
+        run = np.stack([encode(chunk['userid'], user_index), encode(chunk['itemid'], item_index),
+                        chunk['timestamp'].to_numpy(np.int64)])
+        block = run[0] // bucket_users
+        order = np.argsort(block, kind='stable')
+        bounds = np.searchsorted(block[order], np.arange(block.max() + 2))
+        for b in np.unique(block):
+            path = os.path.join(spill_dir, f'{b}_{n}.npy')
+            np.save(path, run[:, order[bounds[b]:bounds[b + 1]]])
+            runs.append((b, path))
+    return runs, list(user_index), list(item_index)
+
+
+def merge_runs(runs, num_user, bucket_users, user_map=None, item_map=None):
+    '''
+    Yield (base, users, user, item, timestamp) of every spilled block, user relative to base.
+    user_map / item_map give the final index of every indexed user / item, -1 for dropped ones.
+    '''
+    for b in range((num_user + bucket_users - 1) // bucket_users):
+        run = np.concatenate([np.load(path) for block, path in runs if block == b], axis=1)
+        if user_map is None:
+            base = b * bucket_users
+            yield base, np.arange(base, min(base + bucket_users, num_user)), run[0] - base, run[1], run[2]
+            continue
+        users = user_map[b * bucket_users:(b + 1) * bucket_users]
+        users = users[users >= 0]
+        if not len(users):
+            continue
+        run = run[:, (user_map[run[0]] >= 0) & (item_map[run[1]] >= 0)]
+        yield users[0], users, user_map[run[0]] - users[0], item_map[run[1]], run[2]
+
+
+def kcore(pairs, num_user, num_item, k):
+    '''
+    k-core of the ratings yielded as (user, item) arrays by pairs().
+    Drop users and items with fewer than k ratings among the kept ones until nothing is dropped.
+    Return the final index of every user / item, -1 for dropped ones.
+    '''
+    keep_user = np.ones(num_user, dtype=bool)
+    keep_item = np.ones(num_item, dtype=bool)
+    while True:
+        user_deg = np.zeros(num_user, dtype=np.int64)
+        item_deg = np.zeros(num_item, dtype=np.int64)
+        for user, item in pairs():
+            kept = keep_user[user] & keep_item[item]
+            user_deg += np.bincount(user[kept], minlength=num_user)
+            item_deg += np.bincount(item[kept], minlength=num_item)
+        drop_user = keep_user & (user_deg < k)
+        drop_item = keep_item & (item_deg < k)
+        if not drop_user.any() and not drop_item.any():
+            break
+        keep_user &= ~drop_user
+        keep_item &= ~drop_item
+    return (np.where(keep_user, np.cumsum(keep_user) - 1, -1),
+            np.where(keep_item, np.cumsum(keep_item) - 1, -1))
+
+
+def group_by_user(user, item, timestamp, num_user):
+    '''
+    Sort interactions by (user, timestamp).
+    Rows of user u are items[indptr[u]:indptr[u + 1]], oldest first.
+    '''
+    order = np.lexsort((timestamp, user))
+    indptr = np.zeros(num_user + 1, dtype=np.int64)
+    np.cumsum(np.bincount(user, minlength=num_user), out=indptr[1:])
+    return indptr, item[order], timestamp[order]
+
+
+def row_users(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+def ranges(start, stop):
+    # concatenation of arange(start[i], stop[i]) for every i
+    counts = stop - start
+    offsets = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(offsets - start, counts)
+
+
+def leave_one_out(indptr, timestamp, validation):
+    '''
+    Test item = first occurrence of the latest timestamp of each user.
+    Validation item = the same among the other items of the user.
+    Return the part (TRAIN / TEST / VAL) of every interaction.
+    '''
+    seg = row_users(indptr)
+    row = np.arange(len(seg))
+    # first row with the timestamp of each row
+    new = np.append(True, (timestamp[1:] != timestamp[:-1]) | (seg[1:] != seg[:-1]))
+    first = np.maximum.accumulate(np.where(new, row, 0))
+    start, end = indptr[:-1], indptr[1:]
+    has = end > start
+    start, end = start[has], end[has]
+    test = first[end - 1]
+    part = np.full(len(seg), TRAIN, dtype=np.int8)
+    part[test] = TEST
+    if validation:
+        # the next row ties with the test timestamp, or else the latest earlier timestamp
+        val = np.where(test + 1 < end, test + 1, first[np.maximum(test - 1, 0)])
+        part[val[(test + 1 < end) | (test > start)]] = VAL
+    return part
+
+
+def ratio_split(indptr, users, random, validation, ratio=0.2, val_ratio=0.1):
+    '''
+    Test items = random round(n * ratio) items of each user.
+    Validation items = the next random round(n * val_ratio) items.
+    Return the part (TRAIN / TEST / VAL) of every interaction.
+    '''
+    seg = row_users(indptr)
+    num_test = np.round(np.diff(indptr) * ratio).astype(np.int64)
+    num_val = np.round(np.diff(indptr) * val_ratio).astype(np.int64) if validation else np.zeros_like(num_test)
+    rank = np.arange(len(seg)) - indptr[seg]
+    order = np.lexsort((random.random(users[seg], rank), seg))
+    part = np.full(len(seg), TRAIN, dtype=np.int8)
+    part[order[rank < num_test[seg]]] = TEST
+    part[order[(rank >= num_test[seg]) & (rank < (num_test + num_val)[seg])]] = VAL
+    return part
+
+
+def sorted_unique(keys):
+    keys = np.sort(keys, kind='stable')
+    if len(keys) == 0:
+        return keys
+    return keys[np.append(True, keys[1:] != keys[:-1])]
+
+
+def user_keys(indptr, items, num_item):
+    # sorted, unique user * num_item + item keys for membership tests
+    return sorted_unique(row_users(indptr) * num_item + items)
+
+
+def complement(keys, users, num_item):
+    '''
+    Items not in keys for each of users.
+    Yield (users, indptr, items) blocks so memory stays bounded by BLOCK_CELLS.
+    '''
+    block = max(1, BLOCK_CELLS // max(num_item, 1))
+    for start in range(0, len(users), block):
+        ub = users[start:start + block]
+        lo = np.searchsorted(keys, ub * num_item)
+        hi = np.searchsorted(keys, (ub + 1) * num_item)
+        mask = np.ones((len(ub), num_item), dtype=bool)
+        mask[np.repeat(np.arange(len(ub)), hi - lo), keys[ranges(lo, hi)] % num_item] = False
+        items = np.nonzero(mask)[1]
+        indptr = np.zeros(len(ub) + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=indptr[1:])
+        yield ub, indptr, items.astype(np.int64)
+
+
+def sample_negatives(keys, num_item, num_neg, users, random):
+    '''
+    Draw num_neg[u] distinct items of user u that are not in keys.
+    Users are local indices. users[u] is the user id the draws are keyed by.
+    Users with fewer candidates than num_neg[u] get all of them.
+    Return the sampled items as (indptr, items).
+    '''
+    num_user = len(num_neg)
+    free = num_item - np.bincount(keys // num_item, minlength=num_user)
+    num_neg = np.minimum(num_neg, free)
+    out_user, out_item = [], []
+
+    # Users needing more than half of their candidates : sample from the materialized complement
+    dense = np.flatnonzero((num_neg > 0) & (num_neg * 2 > free))
+    for ub, indptr, items in complement(keys, dense, num_item):
+        seg = row_users(indptr)
+        order = np.lexsort((random.random(users[ub[seg]], items), seg))
+        rank = np.arange(len(items)) - indptr[seg]
+        take = order[rank < num_neg[ub][seg]]
+        out_user.append(ub[seg[take]])
+        out_item.append(items[take])
+
+    # Others : uniform draws with rejection, a chunk of users at a time
+    need = num_neg.copy()
+    need[dense] = 0
+    sparse = np.flatnonzero(need > 0)
+    chunk = (np.cumsum(need[sparse] * 2 + 4) - 1) // (BLOCK_CELLS >> 3)
+    for todo in np.split(sparse, np.flatnonzero(np.diff(chunk)) + 1):
+        if not len(todo):
+            continue
+        lo, hi = np.searchsorted(keys, [todo[0] * num_item, (todo[-1] + 1) * num_item])
+        cand_user, cand = draw_distinct(keys[lo:hi], todo, need, num_item, users, random)
+        out_user.append(cand_user)
+        out_item.append(cand)
+
+    out_user = np.concatenate(out_user) if out_user else np.zeros(0, dtype=np.int64)
+    out_item = np.concatenate(out_item) if out_item else np.zeros(0, dtype=np.int64)
+    order = np.argsort(out_user, kind='stable')
+    indptr = np.zeros(num_user + 1, dtype=np.int64)
+    np.cumsum(np.bincount(out_user, minlength=num_user), out=indptr[1:])
+    return indptr, out_item[order]
+
+
+def draw_distinct(taken, todo, need, num_item, users, random):
+    # uniform draws for todo users, rejecting taken keys and repeated draws until need[u] items are found
+    need = need.copy()
+    drawn = np.zeros(len(need), dtype=np.int64)
+    out_user, out_item = [], []
+    while len(todo):
+        draws = need[todo] * 2 + 4
+        cand_user = np.repeat(todo, draws)
+        counter = ranges(drawn[todo], drawn[todo] + draws)
+        drawn[todo] += draws
+        cand = cand_user * num_item + random.integers(users[cand_user], counter, num_item)
+        pos = np.minimum(np.searchsorted(taken, cand), max(len(taken) - 1, 0))
+        fresh = taken[pos] != cand if len(taken) else np.ones(len(cand), dtype=bool)
+        # keep the first draw of each distinct item, in draw order
+        order = np.argsort(cand, kind='stable')
+        first = order[np.append(True, cand[order[1:]] != cand[order[:-1]])]
+        first = np.sort(first[fresh[first]])
+        cand_user, cand = cand_user[first], cand[first]
+        start = np.searchsorted(cand_user, cand_user, side='left')
+        keep = np.arange(len(cand)) - start < need[cand_user]
+        cand_user, cand = cand_user[keep], cand[keep]
+        out_user.append(cand_user)
+        out_item.append(cand % num_item)
+        np.subtract.at(need, cand_user, 1)
+        taken = sorted_unique(np.concatenate([taken, cand]))
+        todo = todo[need[todo] > 0]
+    return np.concatenate(out_user), np.concatenate(out_item)
+
+
+def list_batches(users, indptr, items, column):
+    # record batches of one item list per user, each small enough for int32 offsets
+    bounds = np.searchsorted(indptr, np.arange(BLOCK_CELLS, indptr[-1], BLOCK_CELLS))
+    bounds = np.unique(np.concatenate([[0], bounds, [len(users)]]))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        offsets = indptr[start:stop + 1] - indptr[start]
+        values = items[indptr[start]:indptr[stop]]
+        lists = pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), pa.array(values.astype(np.int32)))
+        yield pa.record_batch([pa.array(users[start:stop].astype(np.int32)), lists], names=['userid', column])
+
+
+class FeatherWriter(object):
+    # append record batches of int32 columns to an uncompressed feather (arrow ipc) file, memory-mappable as is
+    def __init__(self, path, column, is_list):
+        value_type = pa.list_(pa.int32()) if is_list else pa.int32()
+        self.column = column
+        self.writer = pa.ipc.new_file(path, pa.schema([('userid', pa.int32()), (column, value_type)]))
+
+    def write_rows(self, users, items):
+        self.writer.write_batch(pa.record_batch([pa.array(users.astype(np.int32)), pa.array(items.astype(np.int32))],
+                                                names=['userid', self.column]))
+
+    def write_lists(self, users, indptr, items):
+        for batch in list_batches(users, indptr, items, self.column):
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class CSRWriter(object):
+    # append item lists of consecutive users to <name>_indptr.npy / <name>_indices.npy
+    def __init__(self, save_dir, name, dtype=np.int32):
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self.indptr_path = os.path.join(save_dir, f'{name}_indptr.npy')
+        self.indices_path = os.path.join(save_dir, f'{name}_indices.npy')
+        self.dtype = dtype
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.count = 0
+        self.tmp = open(self.indices_path + '.tmp', 'wb')
+
+    def write_lists(self, users, indptr, items):
+        self.indptr.append(indptr[1:] + self.count)
+        self.tmp.write(items.astype(self.dtype).tobytes())
+        self.count += int(indptr[-1])
+
+    def close(self):
+        self.tmp.close()
+        np.save(self.indptr_path, np.concatenate(self.indptr))
+        indices = np.lib.format.open_memmap(self.indices_path, mode='w+', dtype=self.dtype, shape=(self.count,))
+        if self.count:
+            indices[:] = np.memmap(self.indices_path + '.tmp', dtype=self.dtype, mode='r', shape=(self.count,))
+        indices.flush()
+        del indices
+        os.remove(self.indices_path + '.tmp')
+
+
+class SplitWriter(object):
+    '''
+    Write the split of one protocol, one block of consecutive users at a time.
+    ftr : train_positive / (val_positive /) test_positive / train_negative / test_negative.ftr
+    csr : train_positive / (val_positive /) test_positive / test_negative indptr + indices
+    '''
+
+    def __init__(self, save_dir, save_format, num_item, validation):
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self.save_format = save_format
+        self.num_item = num_item
+        self.positives = ['train', 'val', 'test'] if validation else ['train', 'test']
+        if save_format == 'csr':
+            # train negatives are derived from these lists at sampling time
+            self.files = {name: CSRWriter(save_dir, name)
+                          for name in [f'{p}_positive' for p in self.positives] + ['test_negative']}
+        else:
+            self.files = {f'{p}_positive': FeatherWriter(os.path.join(save_dir, f'{p}_positive.ftr'), f'{p}_pos', False)
+                          for p in self.positives}
+            self.files['train_negative'] = FeatherWriter(os.path.join(save_dir, 'train_negative.ftr'), 'train_negative', True)
+            self.files['test_negative'] = FeatherWriter(os.path.join(save_dir, 'test_negative.ftr'), 'test_negative', True)
+
+    def write(self, base, positives, test_negative, exclude):
+        # users of this block are base, base + 1, ... and are local indices in every argument
+        users = base + np.arange(len(test_negative[0]) - 1)
+        for p in self.positives:
+            if self.save_format == 'csr':
+                self.files[f'{p}_positive'].write_lists(users, *positives[p])
+            else:
+                self.files[f'{p}_positive'].write_rows(base + row_users(positives[p][0]), positives[p][1])
+        if self.save_format != 'csr':
+            for ub, indptr, items in complement(exclude, np.arange(len(users)), self.num_item):
+                self.files['train_negative'].write_lists(base + ub, indptr, items)
+        self.files['test_negative'].write_lists(users, *test_negative)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def take(seg, items, mask, num_user):
+    # (indptr, items) of the interactions in mask
+    indptr = np.zeros(num_user + 1, dtype=np.int64)
+    np.cumsum(np.bincount(seg[mask], minlength=num_user), out=indptr[1:])
+    return indptr, items[mask]
+
+
+def split(indptr, items, timestamp, num_item, negative_sampling, validation, seed, users):
+    '''
+    Split grouped interactions of local users 0, 1, ... whose user ids are users, with every protocol.
+    Grouping and positive keys are shared by the protocols.
+    Return {split_type: ({'train', 'val', 'test'}: (indptr, items), test negative, train exclusion)}
+    with lists of local users and sorted keys.
+    '''
+    num_user = len(indptr) - 1
+    seg = row_users(indptr)
+    positive_keys = user_keys(indptr, items, num_item)
+    parts = {'leave-one-out': leave_one_out(indptr, timestamp, validation),
+             'ratio-split': ratio_split(indptr, users, UserRandom(seed, 'ratio-split/test_positive'), validation)}
+    result = {}
+    for split_type in SPLIT_TYPES:
+        part = parts[split_type]
+        positives = {p: take(seg, items, part == code, num_user)
+                     for p, code in [('train', TRAIN), ('val', VAL), ('test', TEST)]}
+
+        if split_type == 'leave-one-out':
+            num_neg = np.full(num_user, 99)
+        elif negative_sampling:
+            num_neg = np.diff(positives['test'][0]) * 10
+        else:
+            num_neg = np.full(num_user, num_item)
+        neg_indptr, neg_items = sample_negatives(positive_keys, num_item, num_neg, users,
+                                                 UserRandom(seed, split_type + '/test_negative'))
+
+        # train negative = items - train positive - val positive - test negative (- test positive in leave-one-out)
+        if split_type == 'leave-one-out':
+            exclude = positive_keys
+        else:
+            exclude = np.concatenate([user_keys(*positives['train'], num_item), user_keys(*positives['val'], num_item)])
+        exclude = sorted_unique(np.concatenate([exclude, user_keys(neg_indptr, neg_items, num_item)]))
+        result[split_type] = positives, (neg_indptr, neg_items), exclude
+    return result
+
+
+def shard_bounds(indptr, num_shard):
+    # consecutive user shards with about the same number of interactions
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], num_shard + 1)[1:-1])
+    return np.unique(np.concatenate([[0], bounds, [len(indptr) - 1]]))
+
+
+def split_task(task):
+    return split(*task)
+
+
+def split_blocks(blocks, save_path, num_item, args):
+    '''
+    Split and save block by block, each block in shards of consecutive users.
+    blocks yield (base, users, user, item, timestamp), user relative to base and users the ids of the block.
+    csr splits also keep the grouped interactions in index-info/history for later updates.
+    '''
+    writers = {split_type: SplitWriter(os.path.join(save_path, split_type), args.save_format, num_item,
+                                       args.validation)
+               for split_type in SPLIT_TYPES}
+    if args.save_format == 'csr':
+        history = [CSRWriter(os.path.join(save_path, 'index-info'), 'history'),
+                   CSRWriter(os.path.join(save_path, 'index-info'), 'history_timestamp', np.int64)]
+    pool = Pool(args.workers) if args.workers > 1 else None
+    for base, users, user, item, timestamp in blocks:
+        indptr, items, timestamp = group_by_user(user, item, timestamp, len(users))
+        if args.save_format == 'csr':
+            history[0].write_lists(users, indptr, items)
+            history[1].write_lists(users, indptr, timestamp)
+        bounds = shard_bounds(indptr, args.workers)
+        tasks = [(indptr[a:b + 1] - indptr[a], items[indptr[a]:indptr[b]], timestamp[indptr[a]:indptr[b]], num_item,
+                  args.negative_sampling, args.validation, args.seed, users[a:b])
+                 for a, b in zip(bounds[:-1], bounds[1:])]
+        results = pool.imap(split_task, tasks) if pool is not None else map(split_task, tasks)
+        for a, result in zip(bounds[:-1], results):
+            for split_type in SPLIT_TYPES:
+                writers[split_type].write(base + a, *result[split_type])
+    if pool is not None:
+        pool.close()
+    for writer in list(writers.values()) + (history if args.save_format == 'csr' else []):
+        writer.close()
+
+
+def save_index(index_dir, user_ids, item_ids, validation):
+    '''
+    Save raw ids of every index as user_index.csv / item_index.csv and as binary id maps
+    (<name>_keys.npy, <name>_sorted_keys.npy, <name>_order.npy) for memory-mapped lookups,
+    and the split options a later --delta_path update has to match as split_info.json.
+    '''
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for name, keys in [('user', user_ids), ('item', item_ids)]:
+        keys = np.asarray(keys)
+        pd.DataFrame({f'{name}id': keys, f'{name}idx': np.arange(len(keys))}).to_csv(
+            os.path.join(index_dir, f'{name}_index.csv'), index=False)
+        if keys.dtype == object:
+            keys = keys.astype(str)
+        order = np.argsort(keys, kind='stable')
+        np.save(os.path.join(index_dir, f'{name}_keys.npy'), keys)
+        np.save(os.path.join(index_dir, f'{name}_sorted_keys.npy'), keys[order])
+        np.save(os.path.join(index_dir, f'{name}_order.npy'), order)
+    with open(os.path.join(index_dir, 'split_info.json'), 'w') as f:
+        json.dump({'validation': validation}, f)
+
+
+def load_validation(save_path):
+    # whether the split in save_path holds val_positive, from split_info.json or the files of older splits
+    path = os.path.join(save_path, 'index-info', 'split_info.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)['validation']
+    return os.path.exists(os.path.join(save_path, SPLIT_TYPES[0], 'val_positive_indptr.npy'))
+
+
+def load_keys(index_dir, name):
+    path = os.path.join(index_dir, f'{name}_keys.npy')
+    if os.path.exists(path):
+        return np.load(path).tolist()
+    return pd.read_csv(os.path.join(index_dir, f'{name}_index.csv'))[f'{name}id'].tolist()
+
+
+def load_lists(save_dir, name):
+    return (np.load(os.path.join(save_dir, f'{name}_indptr.npy'), mmap_mode='r'),
+            np.load(os.path.join(save_dir, f'{name}_indices.npy'), mmap_mode='r'))
+
+
+def patch_lists(old, changed, new, num_user):
+    '''
+    Rows of old (indptr, indices) with the rows of the sorted users changed replaced by new (indptr, indices)
+    and empty rows for users past the end of old.
+    Yield (users, indptr, items) blocks of consecutive users.
+    '''
+    old_indptr, old_indices = old
+    indptr, indices = new
+    num_old = len(old_indptr) - 1
+    bounds = np.searchsorted(old_indptr, np.arange(BLOCK_CELLS, old_indptr[-1], BLOCK_CELLS))
+    bounds = np.unique(np.concatenate([[0], bounds, [num_old, num_user]]))
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        o = max(min(e, num_old), s)
+        lo, hi = np.searchsorted(changed, [s, e])
+        kept = np.asarray(old_indices[old_indptr[s]:old_indptr[o]])
+        values = np.concatenate([kept, np.asarray(indices[indptr[lo]:indptr[hi]]).astype(kept.dtype)])
+        start = np.zeros(e - s, dtype=np.int64)
+        length = np.zeros(e - s, dtype=np.int64)
+        start[:o - s] = old_indptr[s:o] - old_indptr[s]
+        length[:o - s] = np.diff(old_indptr[s:o + 1])
+        start[changed[lo:hi] - s] = indptr[lo:hi] - indptr[lo] + len(kept)
+        length[changed[lo:hi] - s] = np.diff(indptr[lo:hi + 1])
+        out_indptr = np.zeros(e - s + 1, dtype=np.int64)
+        np.cumsum(length, out=out_indptr[1:])
+        yield np.arange(s, e), out_indptr, values[ranges(start, start + length)]
+
+
+def update(args):
+    '''
+    Add the ratings of args.delta_path to the csr split in args.save_path.
+    New users/items get the next indices, and only users with new ratings are split again.
+    '''
+    index_dir = os.path.join(args.save_path, 'index-info')
+    user_index = {key: idx for idx, key in enumerate(load_keys(index_dir, 'user'))}
+    item_index = {key: idx for idx, key in enumerate(load_keys(index_dir, 'item'))}
+    delta = pd.read_csv(args.delta_path)
+    user, item = encode(delta['userid'], user_index), encode(delta['itemid'], item_index)
+    timestamp = delta['timestamp'].to_numpy(np.int64)
+    num_user, num_item = len(user_index), len(item_index)
+    del delta
+
+    # full history of the changed users = old history + delta
+    changed = sorted_unique(user)
+    history_indptr, history_items = load_lists(index_dir, 'history')
+    history_timestamp = load_lists(index_dir, 'history_timestamp')[1]
+    known = changed[changed < len(history_indptr) - 1]
+    rows = ranges(history_indptr[known], history_indptr[known + 1])
+    old_user = np.repeat(np.searchsorted(changed, known), np.diff(history_indptr)[known])
+    user = np.concatenate([old_user, np.searchsorted(changed, user)])
+    item = np.concatenate([history_items[rows].astype(np.int64), item])
+    timestamp = np.concatenate([history_timestamp[rows], timestamp])
+
+    # split the changed users into update/, then rewrite every list with their rows replaced
+    stage = os.path.join(args.save_path, 'update')
+    split_blocks([(0, changed, user, item, timestamp)], stage, num_item, args)
+    positives = ['train_positive', 'val_positive', 'test_positive'] if args.validation else ['train_positive', 'test_positive']
+    lists = [(split_type, positives + ['test_negative']) for split_type in SPLIT_TYPES]
+    lists += [('index-info', ['history', 'history_timestamp'])]
+    for save_dir, names in lists:
+        for name in names:
+            old = load_lists(os.path.join(args.save_path, save_dir), name)
+            new = load_lists(os.path.join(stage, save_dir), name)
+            writer = CSRWriter(os.path.join(stage, 'patched'), name, old[1].dtype)
+            for users, indptr, items in patch_lists(old, changed, new, num_user):
+                writer.write_lists(users, indptr, items)
+            writer.close()
+            del old
+            for path in [writer.indptr_path, writer.indices_path]:
+                os.replace(path, os.path.join(args.save_path, save_dir, os.path.basename(path)))
+    shutil.rmtree(stage)
+
+    save_index(index_dir, list(user_index), list(item_index), args.validation)
+
+
+def main(args):
+    if args.delta_path:
+        if args.save_format != 'csr':
+            parser.error('--delta_path updates a split saved with --save_format csr')
+        if args.kcore > 0:
+            parser.error('--kcore is not applied to --delta_path updates')
+        if load_validation(args.save_path) != args.validation:
+            # the patched positive lists have to be the ones of the split
+            parser.error('--validation has to match the split in --save_path')
+        update(args)
+        return
+
+    if args.chunk_size > 0:
+        spill_dir = os.path.join(args.save_path, 'spill')
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        runs, user_ids, item_ids = stream_ratings(args.data_path, args.chunk_size, spill_dir, args.bucket_users)
+        num_user = len(user_ids)
+        user_map = item_map = None
+        if args.kcore > 0:
+            user_map, item_map = kcore(lambda: (np.load(path)[:2] for block, path in runs),
+                                       num_user, len(item_ids), args.kcore)
+            user_ids = np.asarray(user_ids)[user_map >= 0]
+            item_ids = np.asarray(item_ids)[item_map >= 0]
+        blocks = merge_runs(runs, num_user, args.bucket_users, user_map, item_map)
+    else:
+        ratings = pd.read_csv(args.data_path)
+        user, item, user_ids, item_ids = index_ratings(ratings)
+        timestamp = ratings['timestamp'].to_numpy()
+        del ratings
+        if args.kcore > 0:
+            user_map, item_map = kcore(lambda: [(user, item)], len(user_ids), len(item_ids), args.kcore)
+            kept = (user_map[user] >= 0) & (item_map[item] >= 0)
+            user, item, timestamp = user_map[user[kept]], item_map[item[kept]], timestamp[kept]
+            user_ids, item_ids = user_ids[user_map >= 0], item_ids[item_map >= 0]
+        blocks = [(0, np.arange(len(user_ids)), user, item, timestamp)]
+
+    split_blocks(blocks, args.save_path, len(item_ids), args)
+    if args.chunk_size > 0:
+        shutil.rmtree(spill_dir)
+
+    save_index(os.path.join(args.save_path, 'index-info'), user_ids, item_ids, args.validation)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
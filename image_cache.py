@@ -0,0 +1,71 @@
+import os
+import json
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import torchvision.transforms as transforms
+from PIL import Image
+
+parser = argparse.ArgumentParser(description='image_cache')
+parser.add_argument('--data_path', default='./Amazon-office-raw', type=str,
+                    help='datapath with item_meta.json and index-info')
+parser.add_argument('--size', default=224, type=int,
+                    help='image height and width')
+parser.add_argument('--workers', default=os.cpu_count(), type=int,
+                    help='number of decoding processes')
+parser.add_argument('--chunk', default=256, type=int,
+                    help='images per task')
+
+
+def item_ids(index_dir):
+    # raw item id of every item index
+    path = os.path.join(index_dir, 'item_keys.npy')
+    if os.path.exists(path):
+        return np.load(path).tolist()
+    return pd.read_csv(os.path.join(index_dir, 'item_index.csv'))['itemid'].tolist()
+
+
+def item_paths(data_path):
+    # absolute image path of every item index
+    with open(os.path.join(data_path, 'item_meta.json'), 'rb') as f:
+        meta_data = json.load(f)
+    return [os.path.abspath(os.path.join(data_path, meta_data[f'{item_id}']['image_path']))
+            for item_id in item_ids(os.path.join(data_path, 'index-info'))]
+
+
+def decode(path, resize):
+    # same decoding and Resize as the raw transform of load_data, so cached pixels match the raw path
+    return np.asarray(resize(Image.open(path).convert('RGB'))).transpose(2, 0, 1)
+
+
+def build(task):
+    # decode images of items start, start + 1, ... into the cache
+    cache_path, start, paths, size = task
+    cache = np.load(cache_path, mmap_mode='r+')
+    resize = transforms.Resize((size, size))
+    for i, path in enumerate(paths):
+        cache[start + i] = decode(path, resize)
+    cache.flush()
+    return len(paths)
+
+
+def main(args):
+    paths = item_paths(args.data_path)
+
+    # N x 3 x size x size uint8, row = item index. written to a temporary file and renamed when complete
+    cache_path = os.path.join(args.data_path, 'image_cache.npy')
+    np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.uint8,
+                              shape=(len(paths), 3, args.size, args.size)).flush()
+    tasks = [(cache_path + '.tmp', start, paths[start:start + args.chunk], args.size)
+             for start in range(0, len(paths), args.chunk)]
+    done = 0
+    with Pool(args.workers) as pool:
+        for n in pool.imap_unordered(build, tasks):
+            done += n
+            print(f'{done}/{len(paths)} images')
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,43 @@
+import os
+import argparse
+import numpy as np
+from image_cache import item_paths
+
+parser = argparse.ArgumentParser(description='image_store')
+parser.add_argument('--data_path', default='./Amazon-office-raw', type=str,
+                    help='datapath with item_meta.json and index-info')
+parser.add_argument('--shard_size', default=1024, type=int,
+                    help='shard file size in MB')
+
+
+def main(args):
+    '''
+    Pack the encoded image file of every item into <data_path>/image_store/shard_<k>.bin
+    and save index.npy, index[i] = (shard, offset, length) of the image of item i.
+    '''
+    paths = item_paths(args.data_path)
+    store_dir = os.path.join(args.data_path, 'image_store')
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    shard_size = args.shard_size << 20
+    index = np.zeros((len(paths), 3), dtype=np.int64)
+    shard, offset = 0, 0
+    out = open(os.path.join(store_dir, f'shard_{shard:05d}.bin'), 'wb')
+    for item, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if offset and offset + len(data) > shard_size:
+            out.close()
+            shard, offset = shard + 1, 0
+            out = open(os.path.join(store_dir, f'shard_{shard:05d}.bin'), 'wb')
+        out.write(data)
+        index[item] = shard, offset, len(data)
+        offset += len(data)
+    out.close()
+    # the index is written last, so a store is only used once it is complete
+    np.save(os.path.join(store_dir, 'index.npy'), index)
+    print(f'{len(paths)} images in {shard + 1} shards')
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,641 @@
+import io
+import os
+import pickle
+import shutil
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import torch
+from PIL import Image
+
+
+class CSR(object):
+    '''
+    Item lists of every user stored as indptr + indices.
+    Items of user u = indices[indptr[u]:indptr[u + 1]]
+    '''
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, user):
+        return np.asarray(self.indices[self.indptr[user]:self.indptr[user + 1]])
+
+    def lengths(self):
+        return np.diff(self.indptr)
+
+    def rows(self):
+        # user index of every entry
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def items(self):
+        # item of every entry, in the order of rows()
+        return np.asarray(self.indices[self.indptr[0]:self.indptr[-1]])
+
+    def take(self, users):
+        # lengths and concatenated item lists of users, gathered at once
+        starts = np.asarray(self.indptr[users])
+        lengths = np.asarray(self.indptr[users + 1]) - starts
+        return lengths, np.asarray(self.indices[segment_index(starts, lengths)])
+
+    def sample(self, users, num, rng):
+        # num distinct items of every user in users, gathered at once
+        starts = np.asarray(self.indptr[users])
+        positions = distinct_positions(np.asarray(self.indptr[users + 1]) - starts, num, rng)
+        return np.asarray(self.indices[starts[:, None] + positions])
+
+
+class ChunkedCSR(object):
+    '''
+    Item lists of consecutive users split in several CSR chunks, e.g. the record batches of an arrow file.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.starts = np.cumsum([0] + [len(c) for c in chunks])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, user):
+        c = np.searchsorted(self.starts, user, side='right') - 1
+        return self.chunks[c][user - self.starts[c]]
+
+    def lengths(self):
+        return np.concatenate([c.lengths() for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.int64)
+
+    def rows(self):
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def items(self):
+        return np.concatenate([c.items() for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.int64)
+
+    def take(self, users):
+        chunk = np.searchsorted(self.starts, users, side='right') - 1
+        lengths = np.zeros(len(users), dtype=np.int64)
+        parts = []
+        for c in np.unique(chunk):
+            rows = np.flatnonzero(chunk == c)
+            lengths[rows], items = self.chunks[c].take(users[rows] - self.starts[c])
+            parts.append((rows, items))
+        offsets = np.cumsum(lengths) - lengths
+        items = np.zeros(lengths.sum(), dtype=np.int64)
+        for rows, part in parts:
+            items[segment_index(offsets[rows], lengths[rows])] = part
+        return lengths, items
+
+    def sample(self, users, num, rng):
+        chunk = np.searchsorted(self.starts, users, side='right') - 1
+        items = np.empty((len(users), num), dtype=np.int64)
+        for c in np.unique(chunk):
+            rows = np.flatnonzero(chunk == c)
+            items[rows] = self.chunks[c].sample(users[rows] - self.starts[c], num, rng)
+        return items
+
+
+class ComplementPool(object):
+    '''
+    Negative pool of every user derived at sampling time instead of being stored.
+    Pool of user u = items that are in none of excluded[k][u]
+    Sampling only needs the sorted keys (user * num_item + item) of the excluded pairs, O(interactions).
+    Items are drawn uniformly, or from table (AliasTable) for weighted negatives.
+    '''
+
+    def __init__(self, num_item, excluded, keys=None, table=None):
+        self.num_item = num_item
+        self.excluded = excluded
+        if keys is None:
+            keys = np.unique(np.concatenate([e.rows().astype(np.int64) * num_item + e.items() for e in excluded]))
+        self.keys = keys
+        self.table = table
+
+    def __len__(self):
+        return len(self.excluded[0])
+
+    def __getitem__(self, user):
+        mask = np.ones(self.num_item, dtype=bool)
+        for e in self.excluded:
+            mask[e[user]] = False
+        return np.flatnonzero(mask)
+
+    def contains(self, users, items):
+        # whether item i of user i is excluded, one searchsorted for the whole batch
+        query = users * self.num_item + items
+        found = np.searchsorted(self.keys, query)
+        return (found < len(self.keys)) & (self.keys[np.minimum(found, len(self.keys) - 1)] == query)
+
+    def sample(self, users, num, rng, retries=8):
+        '''
+        num distinct items of the pool of every user in users, like np.random.choice(replace=False) with the
+        table weights if there is a table and uniform otherwise.
+        Every slot draws items in bulk and redraws the excluded ones and the repeats of earlier slots.
+        Users with almost every item excluded fall back to their explicit pool after the retries.
+        '''
+        items = np.empty((len(users), num), dtype=np.int64)
+        for j in range(num):
+            rows = np.arange(len(users))
+            for _ in range(retries):
+                if self.table is None:
+                    items[rows, j] = rng.integers(self.num_item, size=len(rows))
+                else:
+                    items[rows, j] = self.table.sample(len(rows), rng)
+                rows = rows[self.contains(users[rows], items[rows, j]) |
+                            (items[rows, :j] == items[rows, j, None]).any(1)]
+                if len(rows) == 0:
+                    break
+            for row in rows:
+                pool = np.setdiff1d(self[users[row]], items[row, :j])
+                weights = None if self.table is None else self.table.weights[pool]
+                if weights is not None and weights.sum() > 0:
+                    weights = weights / weights.sum()
+                else:
+                    weights = None
+                items[row, j] = rng.choice(pool, p=weights)
+        return items
+
+
+class AliasTable(object):
+    '''
+    Alias method (Walker / Vose) over non-negative weights, e.g. the train degree of every item.
+    A draw is one uniform index k and one coin, k with probability prob[k] and alias[k] otherwise, O(1).
+    '''
+
+    def __init__(self, weights, prob=None, alias=None):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if prob is None:
+            prob, alias = self.build(self.weights)
+        self.prob = prob
+        self.alias = alias
+
+    @staticmethod
+    def build(weights):
+        '''
+        Vose with a fixed order, without a Python loop. The deficits (1 - scaled) of the small items and the
+        surpluses (scaled - 1) of the large items are laid end to end on one line. A small item takes its alias
+        from the large item whose surplus holds the start of its deficit. A large item whose surplus ends
+        inside a deficit drops below 1 and takes the next large item as its alias.
+        '''
+        n = len(weights)
+        prob = np.ones(n)
+        alias = np.arange(n)
+        total = weights.sum()
+        if total <= 0:
+            # no weight at all, uniform
+            return prob, alias
+        scaled = weights * (n / total)
+        small, large = np.flatnonzero(scaled < 1.), np.flatnonzero(scaled >= 1.)
+        if len(small) == 0 or len(large) == 0:
+            return prob, alias
+        deficit_end = np.cumsum(1. - scaled[small])
+        deficit_start = np.concatenate([[0.], deficit_end[:-1]])
+        surplus_end = np.cumsum(scaled[large] - 1.)
+        owner = np.minimum(np.searchsorted(surplus_end, deficit_start, side='right'), len(large) - 1)
+        prob[small], alias[small] = scaled[small], large[owner]
+        # the deficit straddling the end of the surplus of every large item but the last
+        k = np.searchsorted(deficit_end, surplus_end[:-1], side='right')
+        straddle = np.flatnonzero(k < len(small))
+        straddle = straddle[deficit_start[k[straddle]] < surplus_end[straddle]]
+        prob[large[straddle]] = 1. + surplus_end[straddle] - deficit_end[k[straddle]]
+        alias[large[straddle]] = large[straddle + 1]
+        return np.clip(prob, 0., 1.), alias
+
+    def __len__(self):
+        return len(self.weights)
+
+    def sample(self, size, rng):
+        k = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[k], k, self.alias[k])
+
+
+class Candidates(object):
+    '''
+    Test candidates of every test user as a padded [users x max_candidates] matrix.
+    items[k, :lengths[k]] = positives then negatives of users[k], padded with 0
+    The valid entries in row-major order are the flattened test set of CustomDataset.make_testset.
+    '''
+
+    def __init__(self, users, num_pos, lengths, items):
+        self.users = users
+        self.num_pos = num_pos
+        self.lengths = lengths
+        self.items = items
+
+    @classmethod
+    def from_pairs(cls, user, item, negative):
+        # positive (user, item) pairs and the negative lists of every user
+        users, num_pos, lengths, flat = candidate_lists(user, item, negative)
+        items = np.zeros((len(users), lengths.max() if len(users) else 0), dtype=np.int64)
+        items[np.repeat(np.arange(len(users)), lengths), segment_index(np.zeros_like(lengths), lengths)] = flat
+        return cls(users, num_pos, lengths, items)
+
+    def __len__(self):
+        return len(self.users)
+
+    def positive(self):
+        return np.arange(self.items.shape[1]) < self.num_pos[:, None]
+
+    def valid(self):
+        return np.arange(self.items.shape[1]) < self.lengths[:, None]
+
+    def flat_index(self):
+        # position in items.ravel() of every entry of the flattened test set
+        return np.flatnonzero(self.valid())
+
+
+class IdMap(object):
+    '''
+    Raw id <-> index map stored as binary arrays.
+    keys[i] = raw id of index i, sorted_keys = sorted keys, order[j] = index of sorted_keys[j]
+    '''
+
+    def __init__(self, keys, sorted_keys, order):
+        self.keys = keys
+        self.sorted_keys = sorted_keys
+        self.order = order
+
+    @classmethod
+    def from_keys(cls, keys):
+        keys = np.asarray(keys)
+        if keys.dtype == object:
+            keys = keys.astype(str)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys, keys[order], order)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ids(self, index):
+        return np.asarray(self.keys[index])
+
+    def index(self, ids, missing=-1):
+        # index of every raw id, missing for unknown ids
+        ids = np.asarray(ids)
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        if not len(self):
+            return np.full(ids.shape, missing, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_keys, ids), len(self) - 1)
+        found = np.asarray(self.sorted_keys[pos]) == ids
+        return np.where(found, np.asarray(self.order[pos]), missing).astype(np.int64)
+
+    def save(self, index_dir, name):
+        np.save(os.path.join(index_dir, f'{name}_keys.npy'), self.keys)
+        np.save(os.path.join(index_dir, f'{name}_sorted_keys.npy'), self.sorted_keys)
+        np.save(os.path.join(index_dir, f'{name}_order.npy'), self.order)
+
+
+class ImageCache(object):
+    '''
+    Resized uint8 item images (N x 3 x H x W) built by image_cache.py, row = item index.
+    Indexing gathers the images and normalizes them to float tensors.
+    '''
+
+    def __init__(self, array, mean, std):
+        self.array = array
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(np.array(self.array[index])).float().div_(255)
+        return image.sub_(self.mean).div_(self.std)
+
+
+class FeatureBank(object):
+    '''
+    Frozen extractor features (N x D, float16 or float32) built by feature_bank.py, row = item index.
+    Indexing gathers the rows as float32 tensors.
+    '''
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.array[index], dtype=np.float32))
+
+
+class ImageStore(object):
+    '''
+    Encoded item images packed in a few shard files by image_store.py.
+    index[i] = (shard, offset, length) of the image of item i.
+    Shards are memory-mapped on first access in each process.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = np.load(os.path.join(store_dir, 'index.npy'))
+        self.shards = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def __getitem__(self, item):
+        # file object of the encoded image, readable by Image.open
+        if self.shards is None:
+            self.shards = [np.memmap(os.path.join(self.store_dir, f'shard_{k:05d}.bin'), dtype=np.uint8, mode='r')
+                           for k in range(int(self.index[:, 0].max()) + 1 if len(self.index) else 0)]
+        shard, offset, length = self.index[item]
+        return io.BytesIO(self.shards[shard][offset:offset + length])
+
+
+class LazyImages(object):
+    '''
+    Item images decoded and transformed on first access, e.g. inside DataLoader workers.
+    paths : image path or file object (ImageStore) of every item.
+    The most recently used images are kept up to budget bytes.
+    '''
+
+    def __init__(self, paths, transform, budget=1 << 30):
+        self.paths = paths
+        self.transform = transform
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self, item):
+        image = self.cache.get(item)
+        if image is not None:
+            self.cache.move_to_end(item)
+            return image
+        image = self.transform(Image.open(self.paths[item]).convert("RGB"))
+        self.cache[item] = image
+        self.size += image.element_size() * image.nelement()
+        while self.size > self.budget and len(self.cache) > 1:
+            _, old = self.cache.popitem(last=False)
+            self.size -= old.element_size() * old.nelement()
+        return image
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0:
+            return self.load(int(index))
+        return torch.stack([self.load(item) for item in np.asarray(index).tolist()])
+
+
+def distinct_positions(lengths, num, rng, retries=4):
+    '''
+    num distinct positions in [0, lengths[i]) for every row i, uniform like np.random.choice(replace=False).
+    All rows are drawn with replacement at once and the rows with a repeat are redrawn, which is rare when
+    the pools are much larger than num. Rows still repeating after the retries fall back to rng.choice.
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) and lengths.min() < num:
+        raise ValueError('Cannot take a larger sample than population when replace=False')
+    positions = (rng.random((len(lengths), num)) * lengths[:, None]).astype(np.int64)
+    rows = np.arange(len(lengths))
+    for attempt in range(retries + 1):
+        ordered = np.sort(positions[rows], axis=1)
+        rows = rows[(ordered[:, 1:] == ordered[:, :-1]).any(1)]
+        if len(rows) == 0 or attempt == retries:
+            break
+        positions[rows] = (rng.random((len(rows), num)) * lengths[rows, None]).astype(np.int64)
+    for row in rows:
+        positions[row] = rng.choice(lengths[row], num, replace=False)
+    return positions
+
+
+def segment_index(starts, lengths):
+    # index of every entry of the segments starts[k]:starts[k] + lengths[k], segment after segment
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(lengths.sum())
+
+
+def take_lists(lists, users):
+    # lengths and concatenated item lists of users, from a CSR or a list of lists
+    users = np.asarray(users, dtype=np.int64)
+    if isinstance(lists, (CSR, ChunkedCSR)):
+        return lists.take(users)
+    rows = [np.asarray(lists[user], dtype=np.int64) for user in users]
+    return np.array([len(row) for row in rows], dtype=np.int64), \
+        np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+
+def candidate_lists(user, item, negative):
+    '''
+    Positives (user, item pairs) then negatives of every user with a positive, by one stable sort by user.
+    Returns the users, their positive and candidate counts and the concatenated candidate items.
+    '''
+    order = np.argsort(user, kind='stable')
+    users, num_pos = np.unique(user[order], return_counts=True)
+    num_neg, negative = take_lists(negative, users)
+    lengths = num_pos + num_neg
+    offsets = np.cumsum(lengths) - lengths
+    items = np.zeros(lengths.sum(), dtype=np.int64)
+    items[segment_index(offsets, num_pos)] = item[order]
+    items[segment_index(offsets + num_pos, num_neg)] = negative
+    return users, num_pos, lengths, items
+
+
+def sample_negatives(pool, users, num, rng):
+    # num distinct negatives of every user in users, (len(users), num) items
+    users = np.asarray(users, dtype=np.int64)
+    if isinstance(pool, (CSR, ChunkedCSR, ComplementPool)):
+        return pool.sample(users, num, rng)
+    return np.stack([np.asarray(pool[user])[rng.choice(len(pool[user]), num, replace=False)] for user in users])
+
+
+def train_excluded(data_path, train_pos, test_pos, test_negative, val_pos=None):
+    '''
+    Lists whose items are never train negatives of their user, the train_negative of data_split.py:
+    train and val positives and test negatives, plus the test positives in leave-one-out only.
+    '''
+    excluded = [train_pos, test_negative]
+    if val_pos is not None:
+        excluded.append(val_pos)
+    if os.path.basename(os.path.normpath(data_path)) == 'leave-one-out':
+        excluded.append(test_pos)
+    return excluded
+
+
+def has_csr(data_path, name='train_positive'):
+    return os.path.exists(os.path.join(data_path, f'{name}_indptr.npy'))
+
+
+def load_csr(data_path, name, mmap_mode='r'):
+    indptr = np.load(os.path.join(data_path, f'{name}_indptr.npy'), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(data_path, f'{name}_indices.npy'), mmap_mode=mmap_mode)
+    return CSR(indptr, indices)
+
+
+def has_ftr(data_path, name='train_positive'):
+    return os.path.exists(os.path.join(data_path, f'{name}.ftr'))
+
+
+def read_arrow(path):
+    # columns of an uncompressed arrow ipc (feather) file are views of the memory-mapped file
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def load_ftr(data_path, name, num_user=0):
+    '''
+    Item lists of a feather split file without copying them out of the memory-mapped file.
+    List files (userid, list) map every record batch to a CSR chunk.
+    Row files (userid, item) are grouped by user into a CSR of at least num_user users.
+    '''
+    table = read_arrow(os.path.join(data_path, f'{name}.ftr'))
+    column = table.column(1)
+    if pa.types.is_list(column.type):
+        chunks = [CSR(chunk.offsets.to_numpy(), chunk.values.to_numpy()) for chunk in column.chunks]
+        return chunks[0] if len(chunks) == 1 else ChunkedCSR(chunks)
+    users = table.column(0).to_numpy()
+    items = column.to_numpy()
+    if np.any(users[1:] < users[:-1]):
+        order = np.argsort(users, kind='stable')
+        users, items = users[order], items[order]
+    indptr = np.zeros(max(num_user, users.max() + 1 if len(users) else 0) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(users, minlength=len(indptr) - 1), out=indptr[1:])
+    return CSR(indptr, items)
+
+
+def load_id_map(index_dir, name, mmap_mode='r'):
+    # name : 'user' or 'item'
+    if not os.path.exists(os.path.join(index_dir, f'{name}_keys.npy')):
+        # split saved before the binary map
+        return IdMap.from_keys(pd.read_csv(os.path.join(index_dir, f'{name}_index.csv'))[f'{name}id'].to_numpy())
+    return IdMap(np.load(os.path.join(index_dir, f'{name}_keys.npy'), mmap_mode=mmap_mode),
+                 np.load(os.path.join(index_dir, f'{name}_sorted_keys.npy'), mmap_mode=mmap_mode),
+                 np.load(os.path.join(index_dir, f'{name}_order.npy'), mmap_mode=mmap_mode))
+
+
+def has_image_cache(data_path):
+    return os.path.exists(os.path.join(data_path, 'image_cache.npy'))
+
+
+def load_image_cache(data_path, mean, std, mmap_mode='r'):
+    return ImageCache(np.load(os.path.join(data_path, 'image_cache.npy'), mmap_mode=mmap_mode), mean, std)
+
+
+def has_image_store(data_path):
+    return os.path.exists(os.path.join(data_path, 'image_store', 'index.npy'))
+
+
+def load_image_store(data_path):
+    return ImageStore(os.path.join(data_path, 'image_store'))
+
+
+def has_feature_bank(data_path, name='feature_bank'):
+    return os.path.exists(os.path.join(data_path, f'{name}.npy'))
+
+
+def load_feature_bank(data_path, name='feature_bank', mmap_mode='r'):
+    return FeatureBank(np.load(os.path.join(data_path, f'{name}.npy'), mmap_mode=mmap_mode))
+
+
+def load_text_feature(data_path, item_ids, mmap_mode='r'):
+    '''
+    N x 300 float32 text features, row = item index.
+    Memory-mapped from text_feature.npy built by text_feature.py, else gathered from text_feature_vec.pickle.
+    '''
+    if os.path.exists(os.path.join(data_path, 'text_feature.npy')):
+        return np.load(os.path.join(data_path, 'text_feature.npy'), mmap_mode=mmap_mode)
+    with open(os.path.join(data_path, 'text_feature_vec.pickle'), 'rb') as f:
+        text_vec = pickle.load(f)
+    return np.array([text_vec[item_id] for item_id in item_ids], dtype=np.float32)
+
+
+def fingerprint(paths, *keys, contents=()):
+    '''
+    Hash of keys, of the bytes of the files in contents and of the path, size and modification time of
+    the files in paths (files, or directories for the files directly in them).
+    contents are the split and index files, small enough to read, so that a same-size rewrite which keeps
+    the modification time (cp -p, rsync -t) still changes the hash. The large image and feature files are
+    only stat-ed.
+    '''
+    def files(path):
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        return [f for f in names if os.path.isfile(f)]
+
+    h = hashlib.sha1(repr(keys).encode())
+    for path in contents:
+        for f in files(path):
+            h.update(f'{os.path.abspath(f)}\n'.encode())
+            with open(f, 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 20), b''):
+                    h.update(block)
+    for path in paths:
+        for f in files(path):
+            st = os.stat(f)
+            h.update(f'{os.path.abspath(f)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()[:16]
+
+
+def load_snapshot(snapshot_dir, mmap_mode='r'):
+    # name -> memory-mapped array, None if there is no snapshot
+    if not os.path.isdir(snapshot_dir):
+        return None
+    return {name[:-4]: np.load(os.path.join(snapshot_dir, name), mmap_mode=mmap_mode)
+            for name in os.listdir(snapshot_dir) if name.endswith('.npy')}
+
+
+def save_snapshot(snapshot_dir, arrays):
+    # written to a temporary directory and renamed when complete, then memory-mapped
+    tmp_dir = f'{snapshot_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+    if os.path.isdir(snapshot_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.replace(tmp_dir, snapshot_dir)
+    return load_snapshot(snapshot_dir)
+
+
+def shared_array(array):
+    '''
+    Copy of array in shared memory, read by forked processes without copy-on-write.
+    Arrays backed by a file (np.memmap, memory-mapped arrow) are shared through the page cache and returned as they are.
+    '''
+    base = array
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+        if base.base is None:
+            break
+        base = base.base
+    if not isinstance(base, np.ndarray) or isinstance(base, np.memmap) or array.dtype.kind not in 'biuf':
+        return array
+    shared = torch.empty(array.shape, dtype=torch.from_numpy(np.zeros(0, array.dtype)).dtype).share_memory_().numpy()
+    shared[...] = array
+    return shared
+
+
+def share_memory(data):
+    # load_data outputs with every in-memory array moved to shared memory, before forking the ranks
+    if isinstance(data, (tuple, list)):
+        return type(data)(share_memory(d) for d in data)
+    if isinstance(data, dict):
+        return {k: share_memory(v) for k, v in data.items()}
+    if isinstance(data, pd.DataFrame):
+        # one block, so to_numpy() is a view of the shared memory
+        return pd.DataFrame(shared_array(data.to_numpy()), columns=data.columns, copy=False)
+    if isinstance(data, np.ndarray):
+        return shared_array(data)
+    if isinstance(data, CSR):
+        return CSR(shared_array(data.indptr), shared_array(data.indices))
+    if isinstance(data, ChunkedCSR):
+        return ChunkedCSR(share_memory(data.chunks))
+    if isinstance(data, ComplementPool):
+        return ComplementPool(data.num_item, share_memory(data.excluded), shared_array(data.keys),
+                              share_memory(data.table))
+    if isinstance(data, Candidates):
+        return Candidates(*(shared_array(a) for a in (data.users, data.num_pos, data.lengths, data.items)))
+    if isinstance(data, AliasTable):
+        return AliasTable(shared_array(data.weights), shared_array(data.prob), shared_array(data.alias))
+    return data
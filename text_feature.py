@@ -0,0 +1,29 @@
+import os
+import pickle
+import argparse
+import numpy as np
+from image_cache import item_ids
+
+parser = argparse.ArgumentParser(description='text_feature')
+parser.add_argument('--data_path', default='./Amazon-office-raw', type=str,
+                    help='datapath with text_feature_vec.pickle and index-info')
+
+
+def main(args):
+    with open(os.path.join(args.data_path, 'text_feature_vec.pickle'), 'rb') as f:
+        text_vec = pickle.load(f)
+    ids = item_ids(os.path.join(args.data_path, 'index-info'))
+
+    # N x 300 float32, row = item index. written to a temporary file and renamed when complete
+    feature_path = os.path.join(args.data_path, 'text_feature.npy')
+    feature = np.lib.format.open_memmap(feature_path + '.tmp', mode='w+', dtype=np.float32,
+                                        shape=(len(ids), len(text_vec[ids[0]])))
+    for i, item_id in enumerate(ids):
+        feature[i] = text_vec[item_id]
+    feature.flush()
+    del feature
+    os.replace(feature_path + '.tmp', feature_path)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())